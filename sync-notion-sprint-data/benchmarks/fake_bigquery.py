@@ -0,0 +1,135 @@
+# fake_bigquery.py - 記憶體內的 BigQuery 替身 (In-process BigQuery Stand-in)
+#
+# Implements the part of google.cloud.bigquery.Client that main.py calls (query, load_table_from_file,
+# get_table, create_table, delete_table). Loaded rows are kept in memory and every job is recorded, so the
+# real DELETE + load, MERGE and partition code paths run without GCP credentials.
+# Only the statements main.py issues are understood; anything else raises, so drift shows up in the benchmark.
+# google.cloud.bigquery is only imported where it is needed, so the startup probe measures main.py's own imports.
+
+import io
+import re
+import threading
+from types import SimpleNamespace
+
+DELETE_PATTERN = re.compile(r"^DELETE FROM `(?P<table>[^`]+)` WHERE (?P<column>\w+) IN UNNEST\(@sprint_names\) AND Department = @department$")
+MERGE_PATTERN = re.compile(r"^MERGE `(?P<target>[^`]+)` T USING `(?P<staging>[^`]+)` S ON FALSE WHEN NOT MATCHED BY SOURCE AND (?P<partition>T\.sprint_week_start_date = @week_start AND )?T\.(?P<column>\w+) = @sprint_name AND T\.Department = @department THEN DELETE")
+COMPLETED_TASKS_PATTERN = re.compile(r"^SELECT DISTINCT Task_ID, completed_sprint FROM `(?P<table>[^`]+)` WHERE Department = @department$")
+# BigQueryStateStore (BQ_SYNC_STATE_TABLE_ID); rows are {"state_key", "state_value"} dicts
+STATE_GET_PATTERN = re.compile(r"^SELECT state_value FROM `(?P<table>[^`]+)` WHERE state_key = @state_key ORDER BY updated_at DESC LIMIT 1$")
+STATE_GET_MANY_PATTERN = re.compile(r"^SELECT state_key, ANY_VALUE\(state_value HAVING MAX updated_at\) AS state_value FROM `(?P<table>[^`]+)` WHERE STARTS_WITH\(state_key, @key_prefix\) GROUP BY state_key$")
+STATE_MERGE_PATTERN = re.compile(r"^MERGE `(?P<table>[^`]+)` T USING \(SELECT state_key, @state_values\[OFFSET\(i\)\] AS state_value FROM UNNEST\(@state_keys\) AS state_key WITH OFFSET i\) S ON T\.state_key = S\.state_key ")
+
+class FakeJob:
+    def __init__(self, job_type, statement=None, rows=None, output_rows=None, output_bytes=None):
+        self.job_type = job_type
+        self.statement = statement
+        self.rows = rows or []
+        self.output_rows = output_rows
+        self.output_bytes = output_bytes
+        # query cost is not modelled
+        self.total_bytes_processed = None
+        self.total_bytes_billed = None
+
+    def result(self):
+        return list(self.rows)
+
+class FakeBigQueryClient:
+    def __init__(self, project=None, schemas=None, partitioned_tables=()):
+        self.project = project
+        # full table ID -> column names, reported by get_table for the MERGE staging schema
+        self.schemas = dict(schemas or {})
+        # full table IDs reported as day-partitioned by sprint_week_start_date (pruned MERGE of write_mode=partition)
+        self.partitioned_tables = set(partitioned_tables)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # empty tables and job log; one instance is reused like main.py's cached client
+        with self.lock:
+            # full table ID -> list of row dicts
+            self.tables = {}
+            self.jobs = []
+
+    def _record(self, job):
+        self.jobs.append(job)
+        return job
+
+    def query(self, query, job_config=None):
+        # ArrayQueryParameter keeps its items in .values
+        params = {param.name: getattr(param, "values", None) or getattr(param, "value", None) for param in getattr(job_config, "query_parameters", None) or []}
+        statement = " ".join(query.split())
+        with self.lock:
+            if match := DELETE_PATTERN.match(statement):
+                self._delete_rows(match["table"], match["column"], params["sprint_names"], params["department"])
+                return self._record(FakeJob("DELETE", statement))
+            if match := STATE_MERGE_PATTERN.match(statement):
+                rows = self.tables.setdefault(match["table"], [])
+                values = dict(zip(params["state_keys"], params["state_values"]))
+                rows[:] = [row for row in rows if row["state_key"] not in values]
+                rows.extend({"state_key": key, "state_value": value} for key, value in values.items())
+                return self._record(FakeJob("MERGE", statement))
+            if match := STATE_GET_PATTERN.match(statement):
+                rows = [SimpleNamespace(**row) for row in self.tables.get(match["table"], []) if row["state_key"] == params["state_key"]]
+                return self._record(FakeJob("SELECT", statement, rows))
+            if match := STATE_GET_MANY_PATTERN.match(statement):
+                rows = [SimpleNamespace(**row) for row in self.tables.get(match["table"], []) if row["state_key"].startswith(params["key_prefix"])]
+                return self._record(FakeJob("SELECT", statement, rows))
+            if match := MERGE_PATTERN.match(statement):
+                self._delete_rows(match["target"], match["column"], [params["sprint_name"]], params["department"],
+                                  params["week_start"] if match["partition"] else None)
+                self.tables.setdefault(match["target"], []).extend(self.tables.get(match["staging"], []))
+                return self._record(FakeJob("MERGE", statement))
+            if match := COMPLETED_TASKS_PATTERN.match(statement):
+                rows = {(row["Task_ID"], row["completed_sprint"]) for row in self.tables.get(match["table"], []) if row["Department"] == params["department"]}
+                return self._record(FakeJob("SELECT", statement, [SimpleNamespace(Task_ID=task_id, completed_sprint=sprint) for task_id, sprint in rows]))
+        raise NotImplementedError(f"FakeBigQueryClient does not understand: {statement[:200]}")
+
+    def _delete_rows(self, table_id, column, sprint_names, department, week_start=None):
+        rows = self.tables.get(table_id, [])
+        self.tables[table_id] = [row for row in rows if not (row.get(column) in sprint_names and row.get("Department") == department
+                                                             and (week_start is None or row["sprint_week_start_date"] == week_start))]
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, rewind=False):
+        # main.py loads Parquet files written by pyarrow
+        from google.cloud import bigquery
+        import pyarrow.parquet as pq
+        if rewind: file_obj.seek(0)
+        data = file_obj.read()
+        table = pq.read_table(io.BytesIO(data))
+        table_id = destination
+        records = table.to_pylist()
+        truncate = getattr(job_config, "write_disposition", None) == bigquery.WriteDisposition.WRITE_TRUNCATE
+        with self.lock:
+            rows = self.tables.setdefault(table_id, [])
+            if truncate: rows.clear()
+            rows.extend(records)
+            self.schemas.setdefault(table_id, table.column_names)
+            return self._record(FakeJob("LOAD", destination, output_rows=len(records), output_bytes=len(data)))
+
+    def get_table(self, table_id):
+        from google.cloud import bigquery
+        schema = [bigquery.SchemaField(column, "STRING") for column in self.schemas.get(table_id, [])]
+        partitioning = SimpleNamespace(field="sprint_week_start_date", type_="DAY") if table_id in self.partitioned_tables else None
+        return SimpleNamespace(table_id=table_id, schema=schema, time_partitioning=partitioning)
+
+    def create_table(self, table, exists_ok=False):
+        table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        with self.lock:
+            if table_id in self.tables and not exists_ok: raise ValueError(f"Table {table_id} already exists.")
+            self.tables.setdefault(table_id, [])
+        return table
+
+    def delete_table(self, table_id, not_found_ok=False):
+        with self.lock:
+            if self.tables.pop(table_id, None) is None and not not_found_ok: raise KeyError(table_id)
+
+    def summary(self):
+        with self.lock:
+            jobs_by_type = {}
+            for job in self.jobs: jobs_by_type[job.job_type] = jobs_by_type.get(job.job_type, 0) + 1
+            return {
+                "jobs": len(self.jobs),
+                "jobs_by_type": jobs_by_type,
+                "rows_loaded": sum(job.output_rows or 0 for job in self.jobs if job.job_type == "LOAD"),
+                "bytes_loaded": sum(job.output_bytes or 0 for job in self.jobs if job.job_type == "LOAD"),
+            }
@@ -0,0 +1,307 @@
+# fake_notion.py - 本機假 Notion API (Local Fake Notion API)
+#
+# Serves synthetic sprint, task and project boards with the same shapes main.py reads:
+# GET databases/{id}, POST databases/{id}/query (filters, sorts, cursors, filter_properties) and GET pages/{id}.
+# It normally runs in its own process (see start_fake_notion) so its work never shows up in benchmark numbers.
+#
+#   python benchmarks/fake_notion.py --port 8765 --sprints 12 --tasks 150
+
+import argparse
+import json
+import multiprocessing
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+MAX_PAGE_SIZE = 100
+BOARD_START_DATE = date(2024, 1, 1)
+SPRINT_LENGTH_DAYS = 14
+TASK_STATUSES = ("Done", "Done", "Done", "In progress", "Not started")
+STORY_POINTS = ("1", "2", "3", "5", "8")
+
+# ==============================================================================
+# 1. 假資料產生 (Synthetic Boards)
+# ==============================================================================
+
+def _title_property(text):
+    return {"id": "title", "type": "title", "title": [{"type": "text", "plain_text": text}]}
+
+def _relation_property(property_id, page_ids):
+    return {"id": property_id, "type": "relation", "relation": [{"id": page_id} for page_id in page_ids], "has_more": False}
+
+def _page(page_id, properties, last_edited_time):
+    return {"object": "page", "id": page_id, "created_time": last_edited_time, "last_edited_time": last_edited_time,
+            "archived": False, "properties": properties}
+
+def board_config(env):
+    # the NOTION_CONFIGS_JSON entry of a synthetic board, minus TOKEN_VARIABLE_NAME
+    return {
+        "SPRINT_DB_ID": f"{env}-sprint-db", "TASK_DB_ID": f"{env}-task-db", "PROJECT_DB_ID": f"{env}-project-db",
+        "COMPLETED_STATUSES": ["Done"], "DEPARTMENT": env.upper(),
+    }
+
+def build_board(env, sprints=12, tasks_per_sprint=150, subtask_depth=2, projects=30, cross_sprint_parent_ratio=0.05,
+                description_chars=400, seed=0):
+    # one env's sprint, task and project databases; the newest sprint is Current
+    rng = random.Random(f"{env}:{seed}")
+    config = board_config(env)
+    sprint_db_id, task_db_id, project_db_id = config["SPRINT_DB_ID"], config["TASK_DB_ID"], config["PROJECT_DB_ID"]
+
+    project_pages = [
+        _page(f"{env}-project-{i}", {"Project name": _title_property(f"Project {i}")}, "2024-01-01T00:00:00.000Z")
+        for i in range(projects)
+    ]
+
+    sprint_pages = []
+    for number in range(1, sprints + 1):
+        start = BOARD_START_DATE + timedelta(days=(number - 1) * SPRINT_LENGTH_DAYS)
+        status = "Current" if number == sprints else "Done"
+        sprint_pages.append(_page(f"{env}-sprint-{number}", {
+            "Sprint name": _title_property(f"Sprint {number}"),
+            "Sprint status": {"id": "sst", "type": "status", "status": {"name": status}},
+            "Dates": {"id": "dat", "type": "date", "date": {"start": start.isoformat(), "end": (start + timedelta(days=SPRINT_LENGTH_DAYS - 1)).isoformat()}},
+        }, f"{start.isoformat()}T00:00:00.000Z"))
+
+    # tasks come in chains of subtask_depth + 1: a root task, its subtask, the subtask's subtask, ...
+    # a few roots hang under a task of the previous sprint, which forces a GET pages/{id} title lookup
+    task_pages = []
+    previous_sprint_task_ids = []
+    task_number = 0
+    for sprint_page in sprint_pages:
+        sprint_task_ids = []
+        edited_at = sprint_page["last_edited_time"]
+        for i in range(tasks_per_sprint):
+            task_number += 1
+            task_id = f"{env}-task-{task_number}"
+            level = i % (subtask_depth + 1)
+            if level:
+                parent_ids = [sprint_task_ids[-1]]
+            elif previous_sprint_task_ids and rng.random() < cross_sprint_parent_ratio:
+                parent_ids = [rng.choice(previous_sprint_task_ids)]
+            else:
+                parent_ids = []
+            assignee_count = rng.choices((0, 1, 2), weights=(5, 90, 5))[0]
+            # leaves carry the points, parents only sometimes
+            has_points = level == subtask_depth or rng.random() < 0.3
+            task_pages.append(_page(task_id, {
+                "Task name": _title_property(f"Task {task_number}"),
+                "Task ID": {"id": "tid", "type": "unique_id", "unique_id": {"prefix": "T-", "number": task_number}},
+                "Parent-task": _relation_property("par", parent_ids),
+                "Assignee": {"id": "asg", "type": "people", "people": [{"object": "user", "name": f"User {rng.randrange(20)}"} for _ in range(assignee_count)]},
+                "Estimates": {"id": "est", "type": "select", "select": {"name": rng.choice(STORY_POINTS)} if has_points else None},
+                "Project": _relation_property("prj", [f"{env}-project-{rng.randrange(projects)}"] if projects else []),
+                "Status": {"id": "sts", "type": "status", "status": {"name": rng.choice(TASK_STATUSES)}},
+                "Sprint": _relation_property("spr", [sprint_page["id"]]),
+                # properties main.py never reads, so filter_properties has something to save
+                "Description": {"id": "dsc", "type": "rich_text", "rich_text": [{"type": "text", "plain_text": "x" * description_chars}]},
+                "Tags": {"id": "tag", "type": "multi_select", "multi_select": [{"name": f"tag-{rng.randrange(10)}"}]},
+            }, edited_at))
+            sprint_task_ids.append(task_id)
+        previous_sprint_task_ids = sprint_task_ids
+
+    return {"config": config, "databases": {sprint_db_id: sprint_pages, task_db_id: task_pages, project_db_id: project_pages}}
+
+# ==============================================================================
+# 2. 查詢處理 (Query Handling)
+# ==============================================================================
+
+class FakeNotionWorkspace:
+    def __init__(self, boards):
+        self.databases = {}
+        self.pages = {}
+        # (database ID, sprint page ID) -> task pages, so sprint filters do not scan the whole database
+        self.pages_by_sprint = {}
+        for board in boards:
+            for database_id, pages in board["databases"].items():
+                self.databases[database_id] = pages
+                for page in pages:
+                    self.pages[page["id"]] = page
+                    for relation in page["properties"].get("Sprint", {}).get("relation", []):
+                        self.pages_by_sprint.setdefault((database_id, relation["id"]), []).append(page)
+
+    def retrieve_database(self, database_id):
+        pages = self.databases[database_id]
+        properties = {name: {"id": prop["id"], "name": name, "type": prop["type"]} for name, prop in pages[0]["properties"].items()} if pages else {}
+        return {"object": "database", "id": database_id, "properties": properties}
+
+    def _candidates(self, database_id, query_filter):
+        # narrow to one sprint's tasks when the filter starts with a Sprint relation
+        pages = self.databases[database_id]
+        first = (query_filter or {}).get("and", [query_filter])[0] if query_filter else None
+        if first and first.get("property") == "Sprint" and "contains" in first.get("relation", {}):
+            return self.pages_by_sprint.get((database_id, first["relation"]["contains"]), [])
+        return pages
+
+    def query_database(self, database_id, payload, filter_property_ids):
+        query_filter = payload.get("filter")
+        pages = [page for page in self._candidates(database_id, query_filter) if _matches(page, query_filter)]
+        for sort in reversed(payload.get("sorts", [])):
+            pages.sort(key=lambda page: page[sort["timestamp"]], reverse=sort.get("direction") == "descending")
+
+        start = int(payload.get("start_cursor") or 0)
+        page_size = min(int(payload.get("page_size", MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+        batch = pages[start:start + page_size]
+        has_more = start + page_size < len(pages)
+        return {"object": "list", "results": [_project_properties(page, filter_property_ids) for page in batch],
+                "has_more": has_more, "next_cursor": str(start + page_size) if has_more else None}
+
+def _project_properties(page, filter_property_ids):
+    if not filter_property_ids: return page
+    properties = {name: prop for name, prop in page["properties"].items() if prop["id"] in filter_property_ids}
+    return dict(page, properties=properties)
+
+def _matches(page, query_filter):
+    if not query_filter: return True
+    if "and" in query_filter: return all(_matches(page, condition) for condition in query_filter["and"])
+    if "or" in query_filter: return any(_matches(page, condition) for condition in query_filter["or"])
+    if "timestamp" in query_filter:
+        value, condition = page[query_filter["timestamp"]], query_filter[query_filter["timestamp"]]
+        if "on_or_after" in condition: return value >= condition["on_or_after"]
+        if "after" in condition: return value > condition["after"]
+        raise ValueError(f"Unsupported timestamp filter: {condition}")
+
+    prop = page["properties"].get(query_filter["property"], {})
+    if "relation" in query_filter:
+        return query_filter["relation"]["contains"] in [relation["id"] for relation in prop.get("relation", [])]
+    for prop_type in ("status", "select"):
+        if prop_type in query_filter:
+            return (prop.get(prop_type) or {}).get("name") == query_filter[prop_type]["equals"]
+    raise ValueError(f"Unsupported filter: {query_filter}")
+
+# ==============================================================================
+# 3. HTTP 伺服器 (HTTP Server)
+# ==============================================================================
+
+class FakeNotionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, workspace, rate_limit_every=0, latency_ms=0):
+        super().__init__(address, FakeNotionHandler)
+        self.workspace = workspace
+        # every Nth API request is answered with a 429; 0 disables it
+        self.rate_limit_every = rate_limit_every
+        # Retry-After header of those 429s; None leaves it out
+        self.retry_after = "0"
+        self.latency_seconds = latency_ms / 1000
+        self.stats = {}
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def should_rate_limit(self):
+        with self.lock:
+            self.request_count += 1
+            return bool(self.rate_limit_every) and self.request_count % self.rate_limit_every == 0
+
+class FakeNotionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        server = self.server
+        body = self._read_json() if method == "POST" else {}
+
+        # control endpoints used by the benchmark runner
+        if parts == ["_stats"]:
+            with server.lock: return self._send_json(200, dict(server.stats))
+        if parts == ["_reset"]:
+            with server.lock:
+                server.stats, server.request_count = {}, 0
+            return self._send_json(200, {})
+
+        if parts[:1] != ["v1"]: return self._send_json(404, {"object": "error", "message": "Unknown path"})
+        parts = parts[1:]
+        if server.latency_seconds: time.sleep(server.latency_seconds)
+        if server.should_rate_limit():
+            server.count("rate_limited")
+            headers = {"Retry-After": server.retry_after} if server.retry_after is not None else {}
+            return self._send_json(429, {"object": "error", "code": "rate_limited"}, headers)
+
+        workspace = server.workspace
+        try:
+            if method == "POST" and len(parts) == 3 and parts[0] == "databases" and parts[2] == "query":
+                server.count("database_query")
+                filter_property_ids = set(parse_qs(url.query).get("filter_properties", []))
+                return self._send_json(200, workspace.query_database(parts[1], body, filter_property_ids))
+            if method == "GET" and len(parts) == 2 and parts[0] == "databases":
+                server.count("database_retrieve")
+                return self._send_json(200, workspace.retrieve_database(parts[1]))
+            if method == "GET" and len(parts) == 2 and parts[0] == "pages":
+                server.count("page_retrieve")
+                return self._send_json(200, workspace.pages[parts[1]])
+        except KeyError as e:
+            return self._send_json(404, {"object": "error", "code": "object_not_found", "message": f"Could not find {e}"})
+        except ValueError as e:
+            return self._send_json(400, {"object": "error", "code": "validation_error", "message": str(e)})
+        return self._send_json(404, {"object": "error", "message": f"Unsupported endpoint {method} {url.path}"})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+def serve(boards, port=0, rate_limit_every=0, latency_ms=0, ready_queue=None):
+    server = FakeNotionServer(("127.0.0.1", port), FakeNotionWorkspace(boards), rate_limit_every, latency_ms)
+    if ready_queue is None: print(f"Fake Notion API listening on http://127.0.0.1:{server.server_address[1]}/v1")
+    if ready_queue is not None: ready_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def _serve_generated(envs, board_kwargs, rate_limit_every, latency_ms, ready_queue):
+    serve([build_board(env, **board_kwargs) for env in envs], 0, rate_limit_every, latency_ms, ready_queue)
+
+def start_fake_notion(envs, board_kwargs, rate_limit_every=0, latency_ms=0):
+    # the boards are generated in the child process, so they take no memory in the benchmarked one;
+    # returns (API base URL, process)
+    context = multiprocessing.get_context("spawn")
+    ready_queue = context.Queue()
+    process = context.Process(target=_serve_generated, args=(envs, board_kwargs, rate_limit_every, latency_ms, ready_queue), daemon=True)
+    process.start()
+    port = ready_queue.get(timeout=120)
+    return f"http://127.0.0.1:{port}/v1", process
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic Notion boards for local runs of main.py.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--envs", default="ops,wm")
+    parser.add_argument("--sprints", type=int, default=12)
+    parser.add_argument("--tasks", type=int, default=150)
+    parser.add_argument("--subtask-depth", type=int, default=2)
+    parser.add_argument("--projects", type=int, default=30)
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    parser.add_argument("--latency-ms", type=int, default=0)
+    args = parser.parse_args()
+
+    envs = [env.strip() for env in args.envs.split(",") if env.strip()]
+    boards = [build_board(env, sprints=args.sprints, tasks_per_sprint=args.tasks, subtask_depth=args.subtask_depth, projects=args.projects) for env in envs]
+    configs = {env: dict(board_config(env), TOKEN_VARIABLE_NAME="FAKE_NOTION_TOKEN") for env in envs}
+    print(f"export NOTION_API_BASE_URL=http://127.0.0.1:{args.port}/v1")
+    print("export FAKE_NOTION_TOKEN=fake-token")
+    print(f"export NOTION_CONFIGS_JSON='{json.dumps(configs)}'")
+    serve(boards, args.port, args.rate_limit_every, args.latency_ms)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# run_benchmarks.py - 離線效能基準測試 (Offline Benchmarks)
+#
+# Runs the real notion_bq_sync_trigger against a fake Notion server (separate process) and an in-process
+# BigQuery stand-in, and reports wall time, throughput, Notion/BigQuery call counts and peak Python memory
+# for the current, backfill and multi-env scenarios. Keep the JSON reports (--output) to track changes over time.
+#
+#   python benchmarks/run_benchmarks.py --sprints 20 --tasks 200 --output bench.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+from urllib.request import Request, urlopen
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fake_bigquery import FakeBigQueryClient
+from fake_notion import board_config, start_fake_notion
+
+FAKE_TOKEN_VARIABLE = "BENCH_NOTION_TOKEN"
+# BQ_SYNC_STATE_TABLE_ID of the scenarios that keep sync state in (fake) BigQuery instead of the local file
+BENCH_STATE_TABLE_ID = "sync_state"
+# modules that dominate the cold-start import time of main.py
+HEAVY_MODULES = ("pandas", "pyarrow", "google.cloud.bigquery")
+
+# ==============================================================================
+# 1. 測試情境 (Scenarios)
+# ==============================================================================
+
+def get_scenarios(envs, concurrency):
+    # warmup runs are executed (unmeasured) right before the measured call, on the same fresh state;
+    # "bq_state" scenarios use BigQueryStateStore, so its state queries count towards the BigQuery jobs
+    first_env = envs[0]
+    return [
+        {"name": "current", "args": {"env": first_env, "mode": "current"}},
+        {"name": "incremental_unchanged", "warmup": [{"env": first_env, "mode": "incremental"}],
+         "args": {"env": first_env, "mode": "incremental"}},
+        {"name": "backfill", "args": {"env": first_env, "mode": "backfill", "concurrency": concurrency, "skip_unchanged": "none"}},
+        # the local state file only skips unchanged sprints when asked to; the *_bq_state scenarios do it by default
+        {"name": "backfill_rerun", "warmup": [{"env": first_env, "mode": "backfill", "concurrency": concurrency, "skip_unchanged": "probe"}],
+         "args": {"env": first_env, "mode": "backfill", "concurrency": concurrency, "skip_unchanged": "probe"}},
+        {"name": "backfill_bq_state", "bq_state": True,
+         "args": {"env": first_env, "mode": "backfill", "concurrency": concurrency, "skip_unchanged": "none"}},
+        {"name": "backfill_rerun_bq_state", "bq_state": True, "warmup": [{"env": first_env, "mode": "backfill", "concurrency": concurrency}],
+         "args": {"env": first_env, "mode": "backfill", "concurrency": concurrency}},
+        {"name": "multi_env_current", "args": {"env": "all", "mode": "current"}},
+        {"name": "multi_env_backfill", "args": {"env": "all", "mode": "backfill", "concurrency": concurrency, "skip_unchanged": "none"}},
+    ]
+
+# ==============================================================================
+# 2. 執行與量測 (Running and Measuring)
+# ==============================================================================
+
+def _fake_notion_control(base_url, path):
+    # base_url ends in /v1; the control endpoints sit next to it
+    request = Request(f"{base_url[:-len('/v1')]}/{path}", data=b"" if path == "_reset" else None, method="POST" if path == "_reset" else "GET")
+    with urlopen(request) as response: return json.loads(response.read())
+
+def _clear_instance_caches(main):
+    # what a warm Cloud Function instance would keep between triggers
+    main._project_map_cache.clear()
+    main._sprint_index_cache.clear()
+    main._database_properties_cache.clear()
+
+def _call_trigger(main, args, verbose):
+    request = SimpleNamespace(args={key: str(value) for key, value in args.items()})
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        body, status_code, _ = main.notion_bq_sync_trigger(request)
+    try: return status_code, json.loads(body)
+    except ValueError: return status_code, {"message": body}
+
+def run_scenario(main, base_url, scenario, bq_client, trace_memory, verbose):
+    # every scenario starts from an empty state file, an empty fake BigQuery and cold instance caches
+    with contextlib.suppress(FileNotFoundError): os.remove(main.SYNC_STATE_PATH)
+    with mock.patch.object(main, "BQ_SYNC_STATE_TABLE_ID", BENCH_STATE_TABLE_ID if scenario.get("bq_state") else None):
+        return _run_scenario(main, base_url, scenario, bq_client, trace_memory, verbose)
+
+def _run_scenario(main, base_url, scenario, bq_client, trace_memory, verbose):
+    bq_client.reset()
+    _clear_instance_caches(main)
+    for warmup_args in scenario.get("warmup", []):
+        _call_trigger(main, warmup_args, verbose)
+    _clear_instance_caches(main)
+    jobs_before = len(bq_client.jobs)
+    _fake_notion_control(base_url, "_reset")
+
+    if trace_memory: tracemalloc.start()
+    started_at = time.perf_counter()
+    status_code, body = _call_trigger(main, dict(scenario["args"], metrics="true"), verbose)
+    wall_seconds = time.perf_counter() - started_at
+    peak_bytes = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory: tracemalloc.stop()
+
+    bq_client.jobs = bq_client.jobs[jobs_before:]
+    counters = body.get("metrics", {}).get("counters", {})
+    return {
+        "status_code": status_code,
+        "message": body.get("message"),
+        "wall_seconds": round(wall_seconds, 3),
+        "tasks_fetched": counters.get("tasks_fetched", 0),
+        "tasks_per_second": round(counters.get("tasks_fetched", 0) / wall_seconds, 1) if wall_seconds else None,
+        "notion_calls": _fake_notion_control(base_url, "_stats"),
+        "bigquery": bq_client.summary(),
+        "peak_memory_mb": round(peak_bytes / 2**20, 2) if peak_bytes is not None else None,
+        "metrics": body.get("metrics"),
+    }
+
+def _get_table_schemas(main):
+    dataset = f"{main.BQ_PROJECT_ID}.{main.BQ_DATASET_ID}"
+    return {f"{dataset}.{main.BQ_ALL_TASKS_TABLE_ID}": main.ALL_TASKS_COLUMNS,
+            f"{dataset}.{main.BQ_COMPLETED_TASKS_TABLE_ID}": main.COMPLETED_TASKS_COLUMNS}
+
+def run_startup_probe(env):
+    # runs in a fresh interpreter: time to import main.py, then a cold and a warm mode=current call
+    started_at = time.perf_counter()
+    import main as sync_main
+    import_seconds = time.perf_counter() - started_at
+    loaded_at_import = {name: name in sys.modules for name in HEAVY_MODULES}
+
+    bq_client = FakeBigQueryClient(project=sync_main.BQ_PROJECT_ID, schemas=_get_table_schemas(sync_main))
+    call_seconds = []
+    for _ in range(2):
+        started_at = time.perf_counter()
+        # the first patch imports google.cloud.bigquery, exactly like the first real client creation would
+        with mock.patch("google.cloud.bigquery.Client", lambda project=None: bq_client):
+            _call_trigger(sync_main, {"env": env, "mode": "current"}, verbose=False)
+        call_seconds.append(time.perf_counter() - started_at)
+    print(json.dumps({"import_seconds": round(import_seconds, 3), "cold_call_seconds": round(call_seconds[0], 3),
+                      "warm_call_seconds": round(call_seconds[1], 3), "heavy_modules_loaded_at_import": loaded_at_import}))
+
+def measure_startup(env):
+    # os.environ already holds the benchmark configuration, so the child sees the same fake services
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--startup-probe", env],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def print_report(results):
+    header = f"{'scenario':<24}{'status':>7}{'wall s':>9}{'tasks':>8}{'tasks/s':>10}{'notion':>8}{'429s':>6}{'bq jobs':>9}{'peak MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        notion_calls = sum(count for key, count in result["notion_calls"].items() if key != "rate_limited")
+        peak = f"{result['peak_memory_mb']:.1f}" if result["peak_memory_mb"] is not None else "-"
+        print(f"{name:<24}{result['status_code']:>7}{result['wall_seconds']:>9.2f}{result['tasks_fetched']:>8}"
+              f"{result['tasks_per_second'] or 0:>10.0f}{notion_calls:>8}{result['notion_calls'].get('rate_limited', 0):>6}"
+              f"{result['bigquery']['jobs']:>9}{peak:>9}")
+
+# ==============================================================================
+# 3. 進入點 (Entry Point)
+# ==============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Notion -> BigQuery sync.")
+    parser.add_argument("--envs", default="ops,wm", help="comma-separated env names, one synthetic board each")
+    parser.add_argument("--sprints", type=int, default=12)
+    parser.add_argument("--tasks", type=int, default=150, help="tasks per sprint")
+    parser.add_argument("--subtask-depth", type=int, default=2)
+    parser.add_argument("--projects", type=int, default=30)
+    parser.add_argument("--cross-sprint-parents", type=float, default=0.05, help="share of root tasks whose parent is in the previous sprint")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth Notion request with a 429 (0 = never)")
+    parser.add_argument("--latency-ms", type=int, default=0, help="added latency per Notion request")
+    parser.add_argument("--requests-per-second", type=float, default=1000, help="NOTION_REQUESTS_PER_SECOND for the client")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--write-mode", default="replace")
+    parser.add_argument("--scenarios", help="comma-separated subset of scenario names")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass (it slows the run down)")
+    parser.add_argument("--output", help="write the full JSON report to this path")
+    parser.add_argument("--verbose", action="store_true", help="show the sync's own log output")
+    parser.add_argument("--startup-probe", metavar="ENV", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.startup_probe: return run_startup_probe(args.startup_probe)
+
+    envs = [env.strip() for env in args.envs.split(",") if env.strip()]
+    board_kwargs = {"sprints": args.sprints, "tasks_per_sprint": args.tasks, "subtask_depth": args.subtask_depth,
+                    "projects": args.projects, "cross_sprint_parent_ratio": args.cross_sprint_parents}
+    base_url, notion_process = start_fake_notion(envs, board_kwargs, args.rate_limit_every, args.latency_ms)
+
+    # main.py reads its configuration at import time
+    state_dir = tempfile.mkdtemp(prefix="notion-sync-bench-")
+    os.environ.update({
+        "NOTION_API_BASE_URL": base_url,
+        "NOTION_REQUESTS_PER_SECOND": str(args.requests_per_second),
+        "NOTION_MAX_BACKOFF_SECONDS": "1",
+        FAKE_TOKEN_VARIABLE: "bench-token",
+        "NOTION_CONFIGS_JSON": json.dumps({env: dict(board_config(env), TOKEN_VARIABLE_NAME=FAKE_TOKEN_VARIABLE) for env in envs}),
+        "BQ_PROJECT_ID": "bench-project", "BQ_DATASET_ID": "bench_dataset",
+        "BQ_ALL_TASKS_TABLE_ID": "all_tasks", "BQ_COMPLETED_TASKS_TABLE_ID": "completed_tasks",
+        "BQ_WRITE_MODE": args.write_mode,
+        "SYNC_STATE_PATH": os.path.join(state_dir, "sync_state.json"),
+        "SPRINT_INDEX_CACHE_TTL_SECONDS": "0",
+    })
+    os.environ.pop("BQ_SYNC_STATE_TABLE_ID", None)
+    startup = measure_startup(envs[0])
+    import main as sync_main
+
+    # one fake client for the whole run, handed out by bigquery.Client and then cached by main.py
+    bq_client = FakeBigQueryClient(project=sync_main.BQ_PROJECT_ID, schemas=_get_table_schemas(sync_main))
+    scenarios = get_scenarios(envs, args.concurrency)
+    if args.scenarios:
+        selected = set(args.scenarios.split(","))
+        scenarios = [scenario for scenario in scenarios if scenario["name"] in selected]
+
+    results = {}
+    try:
+        with mock.patch("google.cloud.bigquery.Client", lambda project=None: bq_client):
+            for scenario in scenarios:
+                # wall time comes from a pass without tracemalloc, peak memory from a second pass with it
+                result = run_scenario(sync_main, base_url, scenario, bq_client, trace_memory=False, verbose=args.verbose)
+                if not args.no_memory:
+                    result["peak_memory_mb"] = run_scenario(sync_main, base_url, scenario, bq_client, trace_memory=True, verbose=args.verbose)["peak_memory_mb"]
+                results[scenario["name"]] = dict(result, args=scenario["args"])
+    finally:
+        notion_process.terminate()
+
+    print(f"startup: import main {startup['import_seconds']:.3f}s, cold mode=current call {startup['cold_call_seconds']:.3f}s, "
+          f"warm call {startup['warm_call_seconds']:.3f}s, loaded at import: {startup['heavy_modules_loaded_at_import']}\n")
+    print_report(results)
+    if args.output:
+        report = {"created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "parameters": vars(args),
+                  "startup": startup, "results": results}
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nReport written to {args.output}")
+
+if __name__ == "__main__":
+    main()
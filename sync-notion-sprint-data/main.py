@@ -5,10 +5,24 @@ import json
 import requests
 import re
 import functions_framework
-from google.cloud import bigquery
-import pandas as pd
-from datetime import datetime, timedelta
-import copy
+from datetime import datetime, timedelta, timezone
+import time
+import random
+import threading
+import contextvars
+import contextlib
+import uuid
+import base64
+import io
+import hashlib
+import collections
+import gzip
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, quote
+from requests.adapters import HTTPAdapter
+# google.cloud.bigquery and pyarrow are most of the cold-start import time, so they are imported
+# inside the functions that use them; pandas is only needed for NormalizedTasks.to_frame (debugging)
 
 # ==============================================================================
 # 1. 全域配置讀取 (Global Configuration)
@@ -18,180 +32,1127 @@ BQ_DATASET_ID = os.environ.get("BQ_DATASET_ID")
 BQ_ALL_TASKS_TABLE_ID = os.environ.get("BQ_ALL_TASKS_TABLE_ID")
 BQ_COMPLETED_TASKS_TABLE_ID = os.environ.get("BQ_COMPLETED_TASKS_TABLE_ID")
 NOTION_API_VERSION = os.environ.get("NOTION_API_VERSION", "2022-06-28")
+# replace = DELETE then load, merge = staging table + one MERGE, partition = merge pruned to the week partition,
+# batch = like replace, but the rows of many sprints share one DELETE and one load job per table
+BQ_WRITE_MODES = ("replace", "merge", "partition", "batch")
+BQ_WRITE_MODE = os.environ.get("BQ_WRITE_MODE", "replace").lower()
+BQ_STAGING_TABLE_EXPIRATION_MINUTES = int(os.environ.get("BQ_STAGING_TABLE_EXPIRATION_MINUTES", "60"))
+# write_mode=batch writes the buffered sprints once either threshold is reached (and always at the end of the run)
+BQ_BATCH_MAX_ROWS = int(os.environ.get("BQ_BATCH_MAX_ROWS", "50000"))
+BQ_BATCH_MAX_BYTES = int(os.environ.get("BQ_BATCH_MAX_BYTES", str(64 * 1024 * 1024)))
+# small key/value table for sync state such as incremental high-water marks;
+# without it the state is kept in a local JSON file (only durable on a single machine)
+BQ_SYNC_STATE_TABLE_ID = os.environ.get("BQ_SYNC_STATE_TABLE_ID")
+SYNC_STATE_PATH = os.environ.get("SYNC_STATE_PATH", "/tmp/notion_sync_state.json")
+# mode=incremental still rewrites the current sprint at least this often, to catch removed or archived tasks
+INCREMENTAL_FULL_SYNC_INTERVAL_MINUTES = int(os.environ.get("INCREMENTAL_FULL_SYNC_INTERVAL_MINUTES", "360"))
+# mode=backfill stops starting new sprints once this much of the invocation has passed (keep it below the function timeout)
+BACKFILL_TIME_BUDGET_SECONDS = int(os.environ.get("BACKFILL_TIME_BUDGET_SECONDS", "480"))
+# minimum time a sprint is expected to need; a sprint is only started when this much budget is left
+BACKFILL_SAFETY_MARGIN_SECONDS = int(os.environ.get("BACKFILL_SAFETY_MARGIN_SECONDS", "30"))
+# > 0 lets warm instances reuse the project map across back-to-back triggers
+PROJECT_MAP_CACHE_TTL_SECONDS = int(os.environ.get("PROJECT_MAP_CACHE_TTL_SECONDS", "0"))
+# short-lived reuse of the parsed sprint list on warm instances; 0 disables it
+SPRINT_INDEX_CACHE_TTL_SECONDS = int(os.environ.get("SPRINT_INDEX_CACHE_TTL_SECONDS", "60"))
+# workspace task graph (parent, story points, sprints and title of every task) kept in the sync state store;
+# rebuilt from a full scan of the task database this often and updated from recently edited tasks in between.
+# "auto" only builds it with a durable state store: with the local /tmp file every cold start would repeat the full scan
+TASK_GRAPH_ENABLED = os.environ.get("TASK_GRAPH_ENABLED", "auto").lower()
+TASK_GRAPH_FULL_SCAN_INTERVAL_HOURS = int(os.environ.get("TASK_GRAPH_FULL_SCAN_INTERVAL_HOURS", "24"))
 
-# 全域變數，將在主函式中動態設定
-NOTION_SPRINT_DATABASE_ID = None
-NOTION_TASK_DATABASE_ID = None
-NOTION_PROJECT_DATABASE_ID = None
+# Notion allows an average of about 3 requests per second per integration (token)
+# overridable so the benchmarks can point the client at a local fake Notion server
+NOTION_API_BASE_URL = os.environ.get("NOTION_API_BASE_URL", "https://api.notion.com/v1").rstrip("/")
+NOTION_REQUESTS_PER_SECOND = float(os.environ.get("NOTION_REQUESTS_PER_SECOND", "3"))
+NOTION_MAX_RETRIES = int(os.environ.get("NOTION_MAX_RETRIES", "5"))
+NOTION_MAX_BACKOFF_SECONDS = float(os.environ.get("NOTION_MAX_BACKOFF_SECONDS", "30"))
+NOTION_REQUEST_TIMEOUT_SECONDS = float(os.environ.get("NOTION_REQUEST_TIMEOUT_SECONDS", "60"))
+NOTION_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# upper bound for the 'concurrency' request parameter
+MAX_SPRINT_CONCURRENCY = int(os.environ.get("MAX_SPRINT_CONCURRENCY", "8"))
+# upper bound for the number of envs synced in parallel by env=all or env=a,b,c
+MAX_ENV_CONCURRENCY = int(os.environ.get("MAX_ENV_CONCURRENCY", "8"))
+SYNC_MODES = ("current", "backfill", "incremental")
+# hash = skip the BigQuery uploads when the sprint's fingerprint is unchanged,
+# probe = also skip the task fetch of closed sprints whose latest last_edited_time is unchanged
+SKIP_UNCHANGED_MODES = ("none", "hash", "probe")
+
+# project database ID -> (fetched_at, project_map), kept for the lifetime of the instance
+_project_map_cache = {}
+# (token, sprint database ID) -> (built_at, SprintIndex)
+_sprint_index_cache = {}
+# (token, database ID) -> property schema; property IDs are stable, so it is kept for the lifetime of the instance
+_database_properties_cache = {}
+
+# the only task properties extract_task_data reads, requested through Notion's filter_properties
+TASK_PROPERTY_NAMES = ("Task name", "Task ID", "Parent-task", "Assignee", "Estimates", "Project", "Status")
+# the properties the task graph keeps per task
+TASK_GRAPH_PROPERTY_NAMES = ("Task name", "Parent-task", "Estimates", "Sprint")
+
+# prefix added to every log line, e.g. the sprint a worker thread is processing
+_log_prefix = contextvars.ContextVar("log_prefix", default="")
+
+def log(message=""):
+    message = str(message)
+    body = message.lstrip("\n")
+    print(f"{message[:len(message) - len(body)]}{_log_prefix.get()}{body}")
+
+# metrics of the innermost scope (invocation, env or sprint); worker threads inherit it through copy_context
+_sync_metrics = contextvars.ContextVar("sync_metrics", default=None)
+
+class SyncMetrics:
+    # wall time per stage and counters of one scope; every update is also added to the parent scope,
+    # so stage times of an env or invocation are summed over all of its threads
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.started_at = time.monotonic()
+        self.stage_seconds = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self.lock: self.counters[name] = self.counters.get(name, 0) + amount
+        if self.parent: self.parent.add(name, amount)
+
+    def add_stage_time(self, stage, seconds):
+        with self.lock: self.stage_seconds[stage] = self.stage_seconds.get(stage, 0) + seconds
+        if self.parent: self.parent.add_stage_time(stage, seconds)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "elapsed_seconds": round(time.monotonic() - self.started_at, 3),
+                "stage_seconds": {stage: round(seconds, 3) for stage, seconds in sorted(self.stage_seconds.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+def begin_metrics_scope():
+    # a child of the current scope, active for the rest of the current context
+    metrics = SyncMetrics(parent=_sync_metrics.get())
+    _sync_metrics.set(metrics)
+    return metrics
+
+def count_metric(name, amount=1):
+    metrics = _sync_metrics.get()
+    if metrics is not None and amount: metrics.add(name, amount)
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    # stages may nest, e.g. parent_titles runs inside fetch_and_normalize
+    started_at = time.monotonic()
+    try: yield
+    finally:
+        metrics = _sync_metrics.get()
+        if metrics is not None: metrics.add_stage_time(stage, time.monotonic() - started_at)
+
+def log_event(event, **fields):
+    # one JSON object per line, which Cloud Logging stores as a structured jsonPayload
+    print(json.dumps({"severity": "INFO", "event": event, **fields}, ensure_ascii=False, default=str))
 
 # ==============================================================================
-# 2. 輔助函式 (Helper Functions)
+# 2. Notion API 用戶端 (Notion API Client)
 # ==============================================================================
 
+class TokenBucketRateLimiter:
+    # shared by every thread that uses the same token, so the whole process stays under Notion's limit
+    def __init__(self, rate_per_second, capacity=None):
+        self.rate = rate_per_second
+        # at least one whole token, otherwise a rate below 1 per second could never send anything
+        self.capacity = max(1, capacity or rate_per_second)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def pause(self, seconds):
+        # after a 429 nobody sharing this token may send again until `seconds` have passed
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+# one pooled session and one rate limiter per Notion token, reused by every request in the process
+_notion_sessions = {}
+_notion_rate_limiters = {}
+_notion_client_lock = threading.Lock()
+
+def get_notion_session(notion_token):
+    with _notion_client_lock:
+        session = _notion_sessions.get(notion_token)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Authorization": f"Bearer {notion_token}", "Notion-Version": NOTION_API_VERSION})
+            _notion_sessions[notion_token] = session
+        return session
+
+def get_notion_rate_limiter(notion_token):
+    with _notion_client_lock:
+        rate_limiter = _notion_rate_limiters.get(notion_token)
+        if rate_limiter is None:
+            rate_limiter = TokenBucketRateLimiter(NOTION_REQUESTS_PER_SECOND)
+            _notion_rate_limiters[notion_token] = rate_limiter
+        return rate_limiter
+
+class NotionSnapshot:
+    # raw Notion responses as gzip-compressed JSON lines, keyed by method, path, query parameters and body;
+    # "record" appends every successful response, "replay" answers from the file without any network call
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.responses = {}
+        self.file = None
+        self.lock = threading.Lock()
+        if mode == "replay":
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.responses[self._get_key(entry["method"], entry["path"], entry["params"], entry["body"])] = entry["response"]
+            log(f"Replaying {len(self.responses)} Notion responses from {path}.")
+        else:
+            self.file = gzip.open(path, "at", encoding="utf-8")
+            log(f"Recording Notion responses to {path}.")
+
+    @staticmethod
+    def _get_key(method, path, params, body):
+        # params are (name, value) pairs, which JSON turns into lists on both the record and the replay side
+        return json.dumps([method, path, params, body], sort_keys=True, ensure_ascii=False)
+
+    def lookup(self, method, path, params, body):
+        key = self._get_key(method, path, params, body)
+        if key not in self.responses: raise LookupError(f"Notion {method} {path} is not in snapshot {self.path}.")
+        return self.responses[key]
+
+    def record(self, method, path, params, body, response):
+        line = json.dumps({"method": method, "path": path, "params": params, "body": body, "response": response}, ensure_ascii=False)
+        with self.lock: self.file.write(line + "\n")
+
+    def close(self):
+        if self.file is not None: self.file.close()
+
+# set by use_notion_snapshot, e.g. from the command line; None talks to the Notion API as usual
+_notion_snapshot = None
+
+@contextlib.contextmanager
+def use_notion_snapshot(snapshot):
+    global _notion_snapshot
+    _notion_snapshot = snapshot
+    try:
+        yield snapshot
+    finally:
+        _notion_snapshot = None
+        if snapshot is not None: snapshot.close()
+
+def _get_backoff_seconds(attempt):
+    # exponential backoff with jitter so parallel workers do not retry in lockstep
+    backoff = min(NOTION_MAX_BACKOFF_SECONDS, 2 ** attempt)
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+def _get_retry_after_seconds(response):
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after: return None
+    try: return float(retry_after) + random.uniform(0, 0.5)
+    except ValueError: return None
+
+def notion_request(method, path, notion_token, **kwargs):
+    snapshot = _notion_snapshot
+    if snapshot is not None and snapshot.mode == "replay":
+        count_metric("notion_requests")
+        return snapshot.lookup(method, path, kwargs.get("params"), kwargs.get("json"))
+    session = get_notion_session(notion_token)
+    rate_limiter = get_notion_rate_limiter(notion_token)
+    url = f"{NOTION_API_BASE_URL}/{path}"
+
+    for attempt in range(NOTION_MAX_RETRIES + 1):
+        with timed_stage("notion_rate_limit_wait"): rate_limiter.acquire()
+        count_metric("notion_requests")
+        try:
+            with timed_stage("notion_http"):
+                response = session.request(method, url, timeout=NOTION_REQUEST_TIMEOUT_SECONDS, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == NOTION_MAX_RETRIES: raise
+            count_metric("notion_retries")
+            delay = _get_backoff_seconds(attempt)
+            log(f"Notion {method} {path} failed ({e}). Retrying in {delay:.1f}s (attempt {attempt + 1}/{NOTION_MAX_RETRIES}).")
+            time.sleep(delay)
+            continue
+
+        if response.status_code in NOTION_RETRY_STATUS_CODES and attempt < NOTION_MAX_RETRIES:
+            delay = _get_retry_after_seconds(response) or _get_backoff_seconds(attempt)
+            count_metric("notion_retries")
+            if response.status_code == 429:
+                count_metric("notion_429s")
+                rate_limiter.pause(delay)
+            log(f"Notion {method} {path} returned {response.status_code}. Retrying in {delay:.1f}s (attempt {attempt + 1}/{NOTION_MAX_RETRIES}).")
+            time.sleep(delay)
+            continue
+
+        response.raise_for_status()
+        data = response.json()
+        if snapshot is not None: snapshot.record(method, path, kwargs.get("params"), kwargs.get("json"), data)
+        return data
+
+# ==============================================================================
+# 3. 輔助函式 (Helper Functions)
+# ==============================================================================
+
+class InvocationCache:
+    # memo shared by every env and sprint of one invocation: the first caller computes a value,
+    # concurrent callers with the same key wait for it instead of fetching it again
+    def __init__(self):
+        self.values = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.values: self.values[key] = compute()
+            return self.values[key]
+
+# one BigQuery client per process: warm instances reuse it, its credentials and its HTTP connections
+_bigquery_client = None
+_bigquery_client_lock = threading.Lock()
+
 def initialize_bigquery_client():
+    global _bigquery_client
+    with _bigquery_client_lock:
+        if _bigquery_client is not None: return _bigquery_client
+        try:
+            from google.cloud import bigquery
+            # use project id to create a bigquery client  
+            # client is like a controler that can manipulate the dataset and tables in foospace-data
+            _bigquery_client = bigquery.Client(project=BQ_PROJECT_ID)
+            log(f"BigQuery client initialized for project: {BQ_PROJECT_ID}")
+            return _bigquery_client
+        except Exception as e:
+            # not cached, so the next trigger tries again
+            log(f"Error initializing BigQuery client: {e}")
+            return None
+
+def record_bigquery_job(job):
+    # call after job.result(); query jobs report bytes processed and billed, load jobs the bytes loaded
+    count_metric("bq_jobs")
+    count_metric("bq_bytes_processed", getattr(job, "total_bytes_processed", None) or 0)
+    count_metric("bq_bytes_billed", getattr(job, "total_bytes_billed", None) or 0)
+    count_metric("bq_bytes_loaded", getattr(job, "output_bytes", None) or 0)
+
+def _get_sprint_column(table_id):
+    return "completed_sprint" if table_id == BQ_COMPLETED_TASKS_TABLE_ID else "sprint"
+
+def _load_table_from_arrow(client, table, destination, write_disposition, schema=None):
+    # the rows are written to Parquet once and loaded as a file; no DataFrame conversion on the way
+    from google.cloud import bigquery
+    import pyarrow.parquet as pq
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, write_disposition=write_disposition)
+    if schema: job_config.schema = schema
+    with timed_stage("bq_load"):
+        job = client.load_table_from_file(buffer, destination, job_config=job_config, rewind=True)
+        job.result()
+    record_bigquery_job(job)
+    return job
+
+def _delete_sprint_rows(client, full_table_id, sprint_column, sprint_names, department):
+    # sprint names come from Notion, so they are passed as query parameters rather than spliced into the SQL
+    from google.cloud import bigquery
+    delete_query = f"DELETE FROM `{full_table_id}` WHERE {sprint_column} IN UNNEST(@sprint_names) AND Department = @department"
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("sprint_names", "STRING", list(sprint_names)),
+        bigquery.ScalarQueryParameter("department", "STRING", department),
+    ])
+    with timed_stage("bq_delete"):
+        query_job = client.query(delete_query, job_config=job_config)
+        query_job.result()
+    record_bigquery_job(query_job)
+
+def _delete_and_load_table(table, full_table_id, client, sprint_column, sprint_name, department):
+    if sprint_name and department:
+        log(f"Executing targeted delete for sprint '{sprint_name}' and department '{department}'.")
+        _delete_sprint_rows(client, full_table_id, sprint_column, [sprint_name], department)
+        log("Delete completed.")
+
+    return _load_table_from_arrow(client, table, full_table_id, "WRITE_APPEND").output_rows
+
+def _get_week_start(target_table, table):
+    # the one sprint_week_start_date of the rows, if the table is day-partitioned by it
+    partitioning = target_table.time_partitioning
+    if not partitioning or partitioning.field != "sprint_week_start_date" or partitioning.type_ != "DAY":
+        return None
+    week_starts = set(table.column("sprint_week_start_date").to_pylist()) - {None}
+    if len(week_starts) != 1: return None
+    return week_starts.pop()
+
+def _merge_table_into_table(table, full_table_id, client, sprint_column, sprint_name, department, prune_partition=False):
+    from google.cloud import bigquery
+    # load into a short-lived staging table, then swap the sprint's rows in a single atomic MERGE.
+    # prune_partition (write_mode=partition) limits the delete to the rows' sprint_week_start_date partition,
+    # so the MERGE only scans that partition; other departments and sprints in the same week are kept
+    target_table = client.get_table(full_table_id)
+    week_start = _get_week_start(target_table, table) if prune_partition else None
+    if prune_partition and week_start is None:
+        log(f"Table {full_table_id} is not day-partitioned by sprint_week_start_date. Merging without partition pruning.")
+    schema = [field for field in target_table.schema if field.name in table.column_names]
+    staging_table_id = f"{full_table_id}_staging_{uuid.uuid4().hex[:12]}"
+    staging_table = bigquery.Table(staging_table_id, schema=schema)
+    staging_table.expires = datetime.now(timezone.utc) + timedelta(minutes=BQ_STAGING_TABLE_EXPIRATION_MINUTES)
+    client.create_table(staging_table)
+    try:
+        _load_table_from_arrow(client, table, staging_table_id, "WRITE_TRUNCATE", schema=schema)
+
+        columns = ", ".join(f"`{column}`" for column in table.column_names)
+        source_columns = ", ".join(f"S.`{column}`" for column in table.column_names)
+        # a constant filter on the partitioning column in this clause is what lets BigQuery prune the target
+        partition_filter = "T.sprint_week_start_date = @week_start AND " if week_start else ""
+        merge_query = f"""
+            MERGE `{full_table_id}` T
+            USING `{staging_table_id}` S
+            ON FALSE
+            WHEN NOT MATCHED BY SOURCE AND {partition_filter}T.{sprint_column} = @sprint_name AND T.Department = @department THEN DELETE
+            WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({source_columns})
+        """
+        query_parameters = [
+            bigquery.ScalarQueryParameter("sprint_name", "STRING", sprint_name),
+            bigquery.ScalarQueryParameter("department", "STRING", department),
+        ]
+        if week_start: query_parameters.append(bigquery.ScalarQueryParameter("week_start", "DATE", week_start))
+        query_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        log(f"Merging {table.num_rows} rows for sprint '{sprint_name}' and department '{department}'.")
+        with timed_stage("bq_merge"):
+            merge_job = client.query(merge_query, job_config=query_config)
+            merge_job.result()
+        record_bigquery_job(merge_job)
+        return table.num_rows
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+
+def upload_table_to_bigquery(table, table_id, client, sprint_name=None, department=None, write_mode="replace"):
+    # table is a pyarrow.Table built by process_all_tasks or process_complete_tasks
+    if table.num_rows == 0:
+        log(f"Table for {table_id} is empty. No data to upload.")
+        return 0
+    full_table_id = f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}"
+    log(f"\nAttempting to upload data to BigQuery table: {full_table_id} (write mode: {write_mode})")
     try:
-        # use project id to create a bigquery client  
-        # client is like a controler that can manipulate the dataset and tables in foospace-data
-        client = bigquery.Client(project=BQ_PROJECT_ID)
-        print(f"BigQuery client initialized for project: {BQ_PROJECT_ID}")
-        return client
+        sprint_column = _get_sprint_column(table_id)
+        if write_mode != "replace" and not (sprint_name and department):
+            raise ValueError(f"Write mode '{write_mode}' requires both sprint_name and department.")
+        if write_mode == "merge":
+            output_rows = _merge_table_into_table(table, full_table_id, client, sprint_column, sprint_name, department)
+        elif write_mode == "partition":
+            output_rows = _merge_table_into_table(table, full_table_id, client, sprint_column, sprint_name, department, prune_partition=True)
+        else:
+            output_rows = _delete_and_load_table(table, full_table_id, client, sprint_column, sprint_name, department)
+        count_metric("bq_rows_written", output_rows or 0)
+        log(f"Successfully uploaded {output_rows} rows to {full_table_id}.")
+        return output_rows
     except Exception as e:
-        print(f"Error initializing BigQuery client: {e}")
-        return None
+        log(f"Error uploading data to BigQuery table {full_table_id}: {e}")
+        raise
 
-def upload_dataframe_to_bigquery(df, table_id, client, sprint_name=None, department=None):
-    if df.empty:
-        print(f"DataFrame for {table_id} is empty. No data to upload.")
-        return
+def upload_sprint_batch_to_bigquery(table, table_id, client, sprint_names, department):
+    # one DELETE for every sprint in the batch (also those without rows left) and one load for their rows
     full_table_id = f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}"
-    print(f"\nAttempting to upload data to BigQuery table: {full_table_id}")
+    log(f"\nReplacing {len(sprint_names)} sprint(s) in {full_table_id} with {table.num_rows} rows (write mode: batch)")
     try:
-        delete_query = None
-        if sprint_name and department:
-            if table_id == BQ_ALL_TASKS_TABLE_ID:
-                delete_query = f"DELETE FROM `{full_table_id}` WHERE sprint = '{sprint_name}' AND Department = '{department}'"
-            elif table_id == BQ_COMPLETED_TASKS_TABLE_ID:
-                delete_query = f"DELETE FROM `{full_table_id}` WHERE completed_sprint = '{sprint_name}' AND Department = '{department}'"
-        
-        if delete_query:
-            print(f"Executing targeted delete for sprint '{sprint_name}' and department '{department}'.")
-            query_job = client.query(delete_query)
-            query_job.result()
-            print("Delete completed.")
-        
-        job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
-        job = client.load_table_from_dataframe(df, full_table_id, job_config=job_config)
-        job.result()
-        print(f"Successfully uploaded {job.output_rows} rows to {full_table_id}.")
+        _delete_sprint_rows(client, full_table_id, _get_sprint_column(table_id), sprint_names, department)
+        output_rows = _load_table_from_arrow(client, table, full_table_id, "WRITE_APPEND").output_rows if table.num_rows else 0
+        count_metric("bq_rows_written", output_rows or 0)
+        log(f"Successfully uploaded {output_rows} rows to {full_table_id}.")
+        return output_rows
     except Exception as e:
-        print(f"Error uploading data to BigQuery table {full_table_id}: {e}")
+        log(f"Error uploading data to BigQuery table {full_table_id}: {e}")
         raise
 
+class SprintWriteBatch:
+    # write_mode=batch: output tables of several sprints are buffered and written together; once a batch is in
+    # BigQuery, the fingerprints and the checkpoint of all its sprints are saved in a single state write.
+    # One batch per env, only used by process_sprints' writer (one sprint at a time), so it needs no lock
+    def __init__(self, client, department, state_store, checkpoint=None, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES):
+        self.client = client
+        self.department = department
+        self.state_store = state_store
+        self.checkpoint = checkpoint
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.entries = []
+        self.buffered_rows = 0
+        self.buffered_bytes = 0
+
+    def add(self, sprint_info, tables, result, state):
+        # tables: table ID -> pyarrow.Table, empty for a sprint with nothing to write; state: state key -> value
+        # to save with the batch. result is marked failed in place if the batch cannot be written
+        self.entries.append({"sprint_id": sprint_info["id"], "sprint_name": sprint_info["name"], "tables": tables, "result": result, "state": state})
+        self.buffered_rows += sum(table.num_rows for table in tables.values())
+        self.buffered_bytes += sum(table.nbytes for table in tables.values())
+        if self.buffered_rows >= self.max_rows or self.buffered_bytes >= self.max_bytes: self.flush()
+
+    def flush(self):
+        entries, self.entries = self.entries, []
+        self.buffered_rows = self.buffered_bytes = 0
+        if entries: self._write(entries)
+
+    def _write(self, entries):
+        import pyarrow as pa
+        written = [entry for entry in entries if entry["tables"]]
+        if written:
+            sprint_names = [entry["sprint_name"] for entry in written]
+            log(f"Writing a batch of {len(sprint_names)} sprint(s): {', '.join(sprint_names)}")
+            try:
+                with timed_stage("bq_upload"):
+                    for table_id in written[0]["tables"]:
+                        table = pa.concat_tables([entry["tables"][table_id] for entry in written])
+                        upload_sprint_batch_to_bigquery(table, table_id, self.client, sprint_names, self.department)
+            except Exception as e:
+                log(f"!!! Batched write of {len(sprint_names)} sprint(s) failed: {e}")
+                for entry in written: entry["result"].update(status="failed", error=f"Batched write failed: {e}")
+                # sprints with nothing to write are still checkpointed below
+                entries = [entry for entry in entries if not entry["tables"]]
+        if not entries: return
+        state = {}
+        for entry in entries: state.update(entry["state"])
+        try:
+            if self.checkpoint is not None: self.checkpoint.mark_done([entry["sprint_id"] for entry in entries], state)
+            else: self.state_store.put_many(state)
+        except Exception as e:
+            log(f"!!! A batch of {len(entries)} sprint(s) was written but its sync state could not be saved: {e}")
+            for entry in entries: entry["result"].update(status="failed", error=str(e))
+
+class CompletedTaskIndex:
+    # Task_ID -> sprints it is recorded as completed in, for one department; loaded once per invocation
+    def __init__(self):
+        self.task_sprints = {}
+        self.sprint_tasks = {}
+        self.lock = threading.Lock()
+
+    def add(self, task_id, sprint_name):
+        self.task_sprints.setdefault(task_id, set()).add(sprint_name)
+        self.sprint_tasks.setdefault(sprint_name, set()).add(task_id)
+
+    def is_completed_in_other_sprint(self, task_id, sprint_name):
+        with self.lock:
+            return bool(self.task_sprints.get(task_id, set()) - {sprint_name})
+
+    def replace_sprint(self, sprint_name, task_ids):
+        # mirror a sprint's rows after they were rewritten in BigQuery
+        with self.lock:
+            for task_id in self.sprint_tasks.pop(sprint_name, set()):
+                sprints = self.task_sprints.get(task_id, set())
+                sprints.discard(sprint_name)
+                if not sprints: self.task_sprints.pop(task_id, None)
+            for task_id in task_ids: self.add(task_id, sprint_name)
+
+    def __len__(self):
+        return len(self.task_sprints)
+
+def load_completed_task_index(client, department):
+    from google.cloud import bigquery
+    log(f"Pre-fetching completed Task_IDs for department '{department}'...")
+    completed_task_index = CompletedTaskIndex()
+    full_table_id = f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{BQ_COMPLETED_TASKS_TABLE_ID}"
+    try:
+        query = f"SELECT DISTINCT Task_ID, completed_sprint FROM `{full_table_id}` WHERE Department = @department"
+        job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("department", "STRING", department)])
+        query_job = client.query(query, job_config=job_config)
+        for row in query_job.result():
+            completed_task_index.add(row.Task_ID, row.completed_sprint)
+        record_bigquery_job(query_job)
+        log(f"Found {len(completed_task_index)} completed Task_IDs.")
+    except Exception as e:
+        log(f"Warning: Could not fetch existing Task_IDs. Uniqueness check may not be complete. Error: {e}")
+    return completed_task_index
+
+class ParquetSink:
+    # writes the output tables as local Parquet files instead of loading them into BigQuery, one file per sprint:
+    # <root_dir>/<all_tasks|completed_tasks>/<department>/<sprint>.parquet; rewriting a sprint replaces its file
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        # fingerprints and checkpoints describe what is in this directory, so they are kept in it
+        # rather than in the shared state store; Parquet dataset readers skip files starting with "_"
+        self.state_store = LocalFileStateStore(os.path.join(root_dir, "_sync_state.json"), durable=True)
+
+    def _get_department_dir(self, name, department):
+        return os.path.join(self.root_dir, name, quote(department, safe=" "))
+
+    def write_sprint_table(self, table, name, sprint_name, department):
+        import pyarrow.parquet as pq
+        path = os.path.join(self._get_department_dir(name, department), f"{quote(sprint_name, safe=' ')}.parquet")
+        if table.num_rows == 0:
+            # the sprint has no rows left in this table
+            if os.path.exists(path): os.remove(path)
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # dot files are skipped by Parquet dataset readers, so a half-written file is never picked up
+        temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, path)
+        count_metric("sink_rows_written", table.num_rows)
+        log(f"Wrote {table.num_rows} rows to {path}.")
+        return table.num_rows
+
+    def load_completed_task_index(self, department):
+        import pyarrow.parquet as pq
+        completed_task_index = CompletedTaskIndex()
+        department_dir = self._get_department_dir("completed_tasks", department)
+        file_names = sorted(name for name in os.listdir(department_dir) if name.endswith(".parquet")) if os.path.isdir(department_dir) else []
+        for file_name in file_names:
+            table = pq.read_table(os.path.join(department_dir, file_name), columns=["Task_ID", "completed_sprint"])
+            for task_id, sprint_name in zip(table.column("Task_ID").to_pylist(), table.column("completed_sprint").to_pylist()):
+                completed_task_index.add(task_id, sprint_name)
+        log(f"Found {len(completed_task_index)} completed Task_IDs in {department_dir}.")
+        return completed_task_index
+
+class BigQueryStateStore:
+    # columns: state_key STRING, state_value STRING (JSON), updated_at TIMESTAMP
+    durable = True
+
+    def __init__(self, client, table_id):
+        from google.cloud import bigquery
+        self.client = client
+        self.full_table_id = f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{table_id}"
+        schema = [
+            bigquery.SchemaField("state_key", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("state_value", "STRING"),
+            bigquery.SchemaField("updated_at", "TIMESTAMP"),
+        ]
+        client.create_table(bigquery.Table(self.full_table_id, schema=schema), exists_ok=True)
+
+    def get(self, key):
+        from google.cloud import bigquery
+        query = f"SELECT state_value FROM `{self.full_table_id}` WHERE state_key = @state_key ORDER BY updated_at DESC LIMIT 1"
+        job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("state_key", "STRING", key)])
+        query_job = self.client.query(query, job_config=job_config)
+        rows = list(query_job.result())
+        record_bigquery_job(query_job)
+        return json.loads(rows[0].state_value) if rows else None
+
+    def get_many(self, key_prefix):
+        from google.cloud import bigquery
+        query = f"SELECT state_key, ANY_VALUE(state_value HAVING MAX updated_at) AS state_value FROM `{self.full_table_id}` WHERE STARTS_WITH(state_key, @key_prefix) GROUP BY state_key"
+        job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("key_prefix", "STRING", key_prefix)])
+        query_job = self.client.query(query, job_config=job_config)
+        state = {row.state_key: json.loads(row.state_value) for row in query_job.result()}
+        record_bigquery_job(query_job)
+        return state
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, values):
+        # every key in one MERGE job; the keys and JSON values are passed as two arrays of the same order
+        from google.cloud import bigquery
+        if not values: return
+        query = f"""
+            MERGE `{self.full_table_id}` T
+            USING (SELECT state_key, @state_values[OFFSET(i)] AS state_value FROM UNNEST(@state_keys) AS state_key WITH OFFSET i) S
+            ON T.state_key = S.state_key
+            WHEN MATCHED THEN UPDATE SET state_value = S.state_value, updated_at = CURRENT_TIMESTAMP()
+            WHEN NOT MATCHED THEN INSERT (state_key, state_value, updated_at) VALUES (S.state_key, S.state_value, CURRENT_TIMESTAMP())
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter("state_keys", "STRING", list(values)),
+            bigquery.ArrayQueryParameter("state_values", "STRING", [json.dumps(value, ensure_ascii=False) for value in values.values()]),
+        ])
+        query_job = self.client.query(query, job_config=job_config)
+        query_job.result()
+        record_bigquery_job(query_job)
+
+class LocalFileStateStore:
+    # durable: the file outlives the instance, unlike the default SYNC_STATE_PATH under /tmp
+    def __init__(self, path, durable=False):
+        self.path = path
+        self.durable = durable
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f: return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, key):
+        with self.lock: return self._read().get(key)
+
+    def get_many(self, key_prefix):
+        with self.lock: return {key: value for key, value in self._read().items() if key.startswith(key_prefix)}
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, values):
+        with self.lock:
+            state = self._read()
+            state.update(values)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f: json.dump(state, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+
+def get_sync_state_store(client):
+    if BQ_SYNC_STATE_TABLE_ID and client is not None:
+        return BigQueryStateStore(client, BQ_SYNC_STATE_TABLE_ID)
+    log(f"Warning: BQ_SYNC_STATE_TABLE_ID is not set. Sync state is kept locally in {SYNC_STATE_PATH}.")
+    return LocalFileStateStore(SYNC_STATE_PATH)
+
+class BackfillCheckpoint:
+    # sprints already written by one backfill run, persisted after every sprint (or batch) so a follow-up call can resume;
+    # done_sprint_ids come from the continuation token, for a follow-up call that cannot see this state store
+    def __init__(self, state_store, run_id, env, department, done_sprint_ids=()):
+        self.state_store = state_store
+        self.state_key = f"backfill:{env}:{department}:{run_id}"
+        state = state_store.get(self.state_key) or {}
+        self.done_sprint_ids = set(state.get("done_sprint_ids", [])) | set(done_sprint_ids)
+        self.lock = threading.Lock()
+
+    def is_done(self, sprint_id):
+        with self.lock: return sprint_id in self.done_sprint_ids
+
+    def mark_done(self, sprint_ids, other_state=None):
+        # other_state (e.g. the sprints' fingerprints) is saved in the same state write as the checkpoint
+        with self.lock:
+            done_sprint_ids = self.done_sprint_ids | set(sprint_ids)
+            self.state_store.put_many(dict(other_state or {}, **{self.state_key: {"done_sprint_ids": sorted(done_sprint_ids)}}))
+            self.done_sprint_ids = done_sprint_ids
+
+def get_resume_point(sprints_to_process, checkpoint):
+    # the done sprints for the continuation token: the last one of the leading run of done sprints plus the few done
+    # after a gap (a failed sprint). Sprints are written in order, so the token stays short on long backfills
+    sprint_ids = [sprint_info["id"] for sprint_info in sprints_to_process]
+    leading = 0
+    while leading < len(sprint_ids) and checkpoint.is_done(sprint_ids[leading]): leading += 1
+    resume_point = {"done_through": sprint_ids[leading - 1]} if leading else {}
+    done_after = [sprint_id for sprint_id in sprint_ids[leading:] if checkpoint.is_done(sprint_id)]
+    if done_after: resume_point["done"] = done_after
+    return resume_point
+
+def get_resumed_sprint_ids(sprints_to_process, backfill):
+    # inverse of get_resume_point; a done_through sprint that no longer exists only loses the leading run
+    sprint_ids = [sprint_info["id"] for sprint_info in sprints_to_process]
+    done_sprint_ids = set(backfill.get("done") or [])
+    if backfill.get("done_through") in sprint_ids: done_sprint_ids.update(sprint_ids[:sprint_ids.index(backfill["done_through"]) + 1])
+    return done_sprint_ids
+
+def encode_continuation_token(data):
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_continuation_token(token):
+    padded = token + "=" * (-len(token) % 4)
+    data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+    if not isinstance(data, dict) or not all(key in data for key in ("env", "department", "run_id")):
+        raise ValueError("continuation token is missing env, department or run_id")
+    return data
+
+def get_title_from_properties(properties):
+    for prop_value in properties.values():
+        if prop_value.get("type") == "title":
+            return "".join(t.get("plain_text", "") for t in prop_value["title"])
+    return None
+
 def get_page_title(page_id, notion_token):
+    # raises on request errors, so the caller decides what to do with a failed lookup
+    count_metric("notion_page_title_lookups")
+    page_data = notion_request("GET", f"pages/{page_id}", notion_token)
+    title = get_title_from_properties(page_data.get("properties", {}))
+    if title is not None: return title
+    return f"Unnamed Page (ID: {page_id})"
+
+def get_cached_page_title(page_id, notion_token, page_title_cache):
+    # page_title_cache is an InvocationCache shared by every worker thread, so every page is fetched at most once;
+    # a failed lookup is not cached, the next sprint that needs the title tries again
     if not notion_token: return f"Page Not Found ({page_id})"
-    url = f"https://api.notion.com/v1/pages/{page_id}"
-    headers = {"Authorization": f"Bearer {notion_token}", "Notion-Version": NOTION_API_VERSION}
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        page_data = response.json()
-        properties = page_data.get("properties", {})
-        for prop_value in properties.values():
-            if prop_value.get("type") == "title":
-                return "".join(t.get("plain_text", "") for t in prop_value["title"])
-        return f"Unnamed Page (ID: {page_id})"
+    try: return page_title_cache.get_or_compute(page_id, lambda: get_page_title(page_id, notion_token))
     except Exception as e:
-        print(f"Error fetching page title for ID {page_id}: {e}")
+        log(f"Error fetching page title for ID {page_id}: {e}")
         return f"Error Fetching Page ({page_id})"
 
-def _query_notion_database(database_id, notion_token, query_payload={}):
+def get_database_properties(database_id, notion_token):
+    cache_key = (notion_token, database_id)
+    if cache_key not in _database_properties_cache:
+        database = notion_request("GET", f"databases/{database_id}", notion_token)
+        _database_properties_cache[cache_key] = database.get("properties", {})
+    return _database_properties_cache[cache_key]
+
+def get_filter_property_ids(database_id, notion_token, property_names=None, property_type=None):
+    # None means "request every property", used whenever the schema cannot be read
+    try: properties = get_database_properties(database_id, notion_token)
+    except Exception as e:
+        log(f"Warning: Could not read the schema of database {database_id}. Fetching all properties. Error: {e}")
+        return None
+    property_ids = [prop["id"] for name, prop in properties.items()
+                    if (property_names is None or name in property_names) and (property_type is None or prop.get("type") == property_type)]
+    # Notion returns IDs URL-encoded; requests encodes them again when building the query string
+    return [unquote(property_id) for property_id in property_ids] or None
+
+def _iter_notion_database(database_id, notion_token, query_payload=None, filter_properties=None):
     
     # database_id = Notion database ID
     # notion_token = real Notion API token for authentication 
-    # query_payload = Notion search condition ex. filter, sort, default set empty dict
-    url = f"https://api.notion.com/v1/databases/{database_id}/query"
-    headers = {"Authorization": f"Bearer {notion_token}", "Notion-Version": NOTION_API_VERSION, "Content-Type": "application/json"}
-    # results collected 
-    all_results = []
-    # Notion API might send through multiple pages, bool to check if continue
-    has_more = True
-    # split page cursur to tell Notion where is the next pack of data 
-    next_cursor = None
-    
-    # while there is more data 
-    while has_more:
-        # 
-        payload = copy.deepcopy(query_payload)
-        if next_cursor: payload["start_cursor"] = next_cursor
-        
-        # 
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        data = response.json()
-        all_results.extend(data.get("results", []))
-        has_more = data.get("has_more")
-        next_cursor = data.get("next_cursor")
-    return all_results
+    # query_payload = Notion search condition ex. filter, sort
+    # filter_properties = property IDs to return, None returns every property
+    path = f"databases/{database_id}/query"
+    params = [("filter_properties", property_id) for property_id in filter_properties] if filter_properties else None
 
-def get_sprints(notion_token):
-    if not NOTION_SPRINT_DATABASE_ID: return []
+    def fetch_batch(cursor):
+        # only start_cursor changes between hops, so a shallow copy of the payload is enough
+        payload = dict(query_payload or {})
+        if cursor: payload["start_cursor"] = cursor
+        return notion_request("POST", path, notion_token, json=payload, params=params)
+
+    # pages are yielded batch by batch; the next cursor hop is already in flight while the caller parses the current batch
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        data = fetch_batch(None)
+        while True:
+            count_metric("notion_pages_returned", len(data.get("results", [])))
+            next_batch = None
+            if data.get("has_more") and data.get("next_cursor"):
+                count_metric("notion_cursor_hops")
+                next_batch = prefetcher.submit(contextvars.copy_context().run, fetch_batch, data["next_cursor"])
+            yield from data.get("results", [])
+            if next_batch is None: return
+            data = next_batch.result()
+
+def _query_notion_database(database_id, notion_token, query_payload=None, filter_properties=None):
+    return list(_iter_notion_database(database_id, notion_token, query_payload, filter_properties))
+
+def get_sprints(sprint_database_id, notion_token):
+    if not sprint_database_id: return []
     
     # check function
-    try: return _query_notion_database(NOTION_SPRINT_DATABASE_ID, notion_token)
+    try: return _query_notion_database(sprint_database_id, notion_token)
     except Exception as e:
-        print(f"Error fetching sprints: {e}")
+        log(f"Error fetching sprints: {e}")
         return []
 
-def get_tasks_for_sprint(sprint_id, notion_token):
-    if not NOTION_TASK_DATABASE_ID: return []
+def get_tasks_for_sprint(task_database_id, sprint_id, notion_token, filter_properties=None):
+    # generator, so callers can process each batch while the next one is fetched
+    if not task_database_id: return
     query = {"filter": {"property": "Sprint", "relation": {"contains": sprint_id}}}
-    try: return _query_notion_database(NOTION_TASK_DATABASE_ID, notion_token, query)
+    try: yield from _iter_notion_database(task_database_id, notion_token, query, filter_properties)
     except Exception as e:
-        print(f"Error fetching tasks for sprint {sprint_id}: {e}")
-        return []
+        # surface the failure so the sprint is reported as failed instead of silently skipped
+        log(f"Error fetching tasks for sprint {sprint_id}: {e}")
+        raise
 
-def get_all_projects_map(notion_token):
+def has_sprint_task_edits_since(task_database_id, sprint_id, since_iso, notion_token):
+    # a single page_size=1 query: is any task of this sprint edited at or after the mark?
+    query = {
+        "filter": {"and": [
+            {"property": "Sprint", "relation": {"contains": sprint_id}},
+            {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since_iso}},
+        ]},
+        "page_size": 1,
+    }
+    data = notion_request("POST", f"databases/{task_database_id}/query", notion_token, json=query)
+    return bool(data.get("results"))
+
+def get_latest_task_edit_time(task_database_id, sprint_id, notion_token, filter_properties=None):
+    # newest last_edited_time among the sprint's tasks, from one sorted page_size=1 query
+    query = {
+        "filter": {"property": "Sprint", "relation": {"contains": sprint_id}},
+        "sorts": [{"timestamp": "last_edited_time", "direction": "descending"}],
+        "page_size": 1,
+    }
+    params = [("filter_properties", property_id) for property_id in filter_properties] if filter_properties else None
+    data = notion_request("POST", f"databases/{task_database_id}/query", notion_token, json=query, params=params)
+    results = data.get("results", [])
+    return results[0].get("last_edited_time") if results else None
+
+def get_all_projects_map(project_database_id, notion_token):
     project_map = {}
-    if not NOTION_PROJECT_DATABASE_ID: return project_map
+    if not project_database_id: return project_map
+
+    cached = _project_map_cache.get(project_database_id)
+    if cached and time.monotonic() - cached[0] < PROJECT_MAP_CACHE_TTL_SECONDS:
+        log(f"Using cached project map ({len(cached[1])} projects).")
+        return cached[1]
+
     try:
-        project_pages = _query_notion_database(NOTION_PROJECT_DATABASE_ID, notion_token)
-        for project_page in project_pages:
+        # the query results already carry each page's title property, no per-page lookup needed
+        # only the title property is needed
+        title_property_ids = get_filter_property_ids(project_database_id, notion_token, property_type="title")
+        for project_page in _iter_notion_database(project_database_id, notion_token, filter_properties=title_property_ids):
             project_id = project_page["id"]
-            project_title = get_page_title(project_id, notion_token)
-            if "Error" not in project_title and "Not Found" not in project_title:
-                project_map[project_id] = project_title
+            project_title = get_title_from_properties(project_page.get("properties", {}))
+            if project_title is None: project_title = f"Unnamed Page (ID: {project_id})"
+            project_map[project_id] = project_title
+        if PROJECT_MAP_CACHE_TTL_SECONDS > 0:
+            _project_map_cache[project_database_id] = (time.monotonic(), project_map)
     except Exception as e:
-        print(f"Error fetching projects: {e}")
+        log(f"Error fetching projects: {e}")
     return project_map
 
-def get_subtask_map(task_list_raw):
-    subtask_map = {task_page["id"]: False for task_page in task_list_raw}
-    for task_page in task_list_raw:
-        parent_prop = task_page.get("properties", {}).get("Parent-task", {})
-        relation_list = parent_prop.get("relation")
-        if relation_list:
-            parent_id = relation_list[0]["id"]
-            if parent_id in subtask_map:
-                subtask_map[parent_id] = True
-    return subtask_map
+def get_parent_task_id(task_page):
+    parent_relation = task_page.get("properties", {}).get("Parent-task", {}).get("relation", [])
+    return parent_relation[0].get("id") if parent_relation else None
+
+def get_story_point(properties):
+    estimates_prop = properties.get("Estimates", {}).get("select", {})
+    if estimates_prop:
+        try: return int(estimates_prop.get("name", 0))
+        except (ValueError, TypeError): pass
+    return 0
+
+class TaskGraph:
+    # every task of a task database as id -> [parent id, story points, sprint ids, title], so parent titles and
+    # the children points of parents in other sprints are in-memory lookups; read-only once loaded
+    def __init__(self, tasks=None, high_water_mark=None, full_scan_at=None):
+        self.tasks = tasks or {}
+        # newest last_edited_time seen; the next update only queries tasks edited since then
+        self.high_water_mark = high_water_mark
+        self.full_scan_at = full_scan_at
+        self.children_by_parent = {}
+        self._index_children()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def _index_children(self):
+        self.children_by_parent = {}
+        for task_id, (parent_id, _, _, _) in self.tasks.items():
+            if parent_id: self.children_by_parent.setdefault(parent_id, []).append(task_id)
+
+    def update(self, task_pages):
+        # returns the number of tasks that were added or changed
+        updated = 0
+        for task_page in task_pages:
+            properties = task_page.get("properties", {})
+            title = get_title_from_properties(properties)
+            sprint_ids = [relation["id"] for relation in properties.get("Sprint", {}).get("relation", [])]
+            task = [get_parent_task_id(task_page), get_story_point(properties), sprint_ids,
+                    title if title is not None else f"Unnamed Page (ID: {task_page['id']})"]
+            if self.tasks.get(task_page["id"]) != task:
+                self.tasks[task_page["id"]] = task
+                updated += 1
+            last_edited_time = task_page.get("last_edited_time")
+            if last_edited_time and (self.high_water_mark is None or last_edited_time > self.high_water_mark):
+                self.high_water_mark = last_edited_time
+        if updated: self._index_children()
+        return updated
+
+    def get_title(self, task_id):
+        task = self.tasks.get(task_id)
+        return task[3] if task else None
+
+    def get_story_point(self, task_id):
+        task = self.tasks.get(task_id)
+        return task[1] if task else 0
+
+    def get_children(self, task_id):
+        return self.children_by_parent.get(task_id, [])
+
+    def to_state(self):
+        # gzip-compressed JSON keeps a large board within a single state value
+        tasks_gz = base64.b64encode(gzip.compress(json.dumps(self.tasks, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))).decode("ascii")
+        return {"high_water_mark": self.high_water_mark, "full_scan_at": self.full_scan_at, "tasks_gz": tasks_gz}
+
+    @classmethod
+    def from_state(cls, state):
+        if not state or not state.get("tasks_gz"): return None
+        tasks = json.loads(gzip.decompress(base64.b64decode(state["tasks_gz"])).decode("utf-8"))
+        return cls(tasks, state.get("high_water_mark"), state.get("full_scan_at"))
+
+def load_task_graph(task_database_id, notion_token, state_store):
+    # one paginated scan of the whole task database, then only the tasks edited since the last run
+    state_key = f"task_graph:{task_database_id}"
+    try:
+        graph = TaskGraph.from_state(state_store.get(state_key))
+        now = datetime.now(timezone.utc)
+        full_scan_due = (graph is None or not graph.high_water_mark or not graph.full_scan_at
+                         or now - datetime.fromisoformat(graph.full_scan_at) >= timedelta(hours=TASK_GRAPH_FULL_SCAN_INTERVAL_HOURS))
+        filter_properties = get_filter_property_ids(task_database_id, notion_token, property_names=TASK_GRAPH_PROPERTY_NAMES)
+        with timed_stage("task_graph_scan"):
+            previous_high_water_mark = graph.high_water_mark if graph else None
+            if full_scan_due:
+                log("Building the task graph from a full scan of the task database...")
+                graph = TaskGraph(full_scan_at=now.isoformat(timespec="seconds"))
+                updated = graph.update(_iter_notion_database(task_database_id, notion_token, None, filter_properties))
+            else:
+                # Notion rounds last_edited_time to the minute, so tasks edited in the mark's minute are read again
+                query = {"filter": {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": graph.high_water_mark}}}
+                updated = graph.update(_iter_notion_database(task_database_id, notion_token, query, filter_properties))
+        count_metric("task_graph_tasks_updated", updated)
+        log(f"Task graph has {len(graph)} tasks ({updated} updated).")
+        if full_scan_due or updated or graph.high_water_mark != previous_high_water_mark:
+            state_store.put(state_key, graph.to_state())
+        return graph
+    except Exception as e:
+        log(f"Warning: Could not load the task graph. Falling back to per-sprint lookups. Error: {e}")
+        return None
+
+def resolve_parent_titles(parent_ids, titles_by_id, notion_token, page_title_cache, task_graph=None):
+    parent_title_map = {}
+    missing_ids = []
+
+    # most parents sit in the same sprint, so take their titles from the pages we already have
+    for parent_id in parent_ids:
+        if parent_id in titles_by_id:
+            parent_title_map[parent_id] = titles_by_id[parent_id]
+            page_title_cache.get_or_compute(parent_id, lambda: titles_by_id[parent_id])
+        else:
+            missing_ids.append(parent_id)
+
+    # parents outside this sprint come from the task graph; only pages it does not know need a GET /v1/pages call
+    if task_graph is not None:
+        graph_titles = {parent_id: task_graph.get_title(parent_id) for parent_id in missing_ids}
+        parent_title_map.update((parent_id, title) for parent_id, title in graph_titles.items() if title is not None)
+        missing_ids = [parent_id for parent_id, title in graph_titles.items() if title is None]
+    if missing_ids:
+        log(f"Resolving {len(missing_ids)} parent task title(s) outside this sprint.")
+    for parent_id in missing_ids:
+        parent_title_map[parent_id] = get_cached_page_title(parent_id, notion_token, page_title_cache)
+    return parent_title_map
 
 def get_sprint_name_from_properties(sprint_page_properties):
     name_prop = sprint_page_properties.get("Sprint name", {}).get("title", [])
     return name_prop[0].get("plain_text") if name_prop else "Unnamed Sprint"
 
+SPRINT_NUMBER_PATTERN = re.compile(r'(\d+)')
+
 def get_sprint_number_from_name(sprint_page_properties):
     sprint_name = get_sprint_name_from_properties(sprint_page_properties)
-    match = re.search(r'(\d+)', sprint_name)
+    match = SPRINT_NUMBER_PATTERN.search(sprint_name)
     return int(match.group(1)) if match else 0
 
-def get_current_sprint(notion_token):
-    
-    # check function
-    all_sprints_raw = get_sprints(notion_token)
-    if not all_sprints_raw: return None
-    sprints_list_sorted = sorted(all_sprints_raw, key=lambda s: get_sprint_number_from_name(s.get("properties", {})))
-    for sprint_page in sprints_list_sorted:
-        props = sprint_page.get("properties", {})
-        status_prop = props.get("Sprint status", {})
-        status_name = None
-        if status_prop.get("type") == "status":
-            status_name = status_prop.get("status", {}).get("name")
-        elif status_prop.get("type") == "select":
-            status_name = status_prop.get("select", {}).get("name")
-        if status_name == "Current":
-            date_prop = props.get("Dates", {})
-            return {
-                "id": sprint_page["id"], "name": get_sprint_name_from_properties(props),
-                "start_date": date_prop.get("date", {}).get("start"),
-                "end_date": date_prop.get("date", {}).get("end")
-            }
+def get_select_or_status_name(prop):
+    # "Sprint status" and "Status" may be either a status or a select property
+    if prop.get("type") in ("status", "select"):
+        return (prop.get(prop["type"]) or {}).get("name")
+    return None
+
+def parse_sprint_page(sprint_page):
+    props = sprint_page.get("properties", {})
+    dates = props.get("Dates", {}).get("date") or {}
+    return {
+        "id": sprint_page["id"], "name": get_sprint_name_from_properties(props),
+        "number": get_sprint_number_from_name(props),
+        "status": get_select_or_status_name(props.get("Sprint status", {})),
+        "start_date": dates.get("start"), "end_date": dates.get("end"),
+    }
+
+class SprintIndex:
+    # every sprint parsed once and sorted once by the number in its name, with the Current sprint located up front
+    def __init__(self, sprint_pages):
+        self.sprints = sorted((parse_sprint_page(sprint_page) for sprint_page in sprint_pages), key=lambda sprint: sprint["number"])
+        self.current_position = next((i for i, sprint in enumerate(self.sprints) if sprint["status"] == "Current"), None)
+        for i, sprint in enumerate(self.sprints): sprint["is_current"] = i == self.current_position
+
+    def __len__(self):
+        return len(self.sprints)
+
+    @property
+    def current(self):
+        return self.sprints[self.current_position] if self.current_position is not None else None
+
+    def backfill_range(self, from_sprint=None, to_sprint=None):
+        # oldest sprint up to and including Current; every sprint when none is Current
+        end = self.current_position + 1 if self.current_position is not None else len(self.sprints)
+        return [sprint for sprint in self.sprints[:end]
+                if (from_sprint is None or sprint["number"] >= from_sprint) and (to_sprint is None or sprint["number"] <= to_sprint)]
+
+def _get_cached_sprint_index(cache_key):
+    cached = _sprint_index_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < SPRINT_INDEX_CACHE_TTL_SECONDS: return cached[1]
     return None
 
+def get_sprint_index(sprint_database_id, notion_token):
+    cache_key = (notion_token, sprint_database_id)
+    sprint_index = _get_cached_sprint_index(cache_key)
+    if sprint_index is not None:
+        log(f"Using cached sprint index ({len(sprint_index)} sprints).")
+        return sprint_index
+
+    sprint_index = SprintIndex(get_sprints(sprint_database_id, notion_token))
+    # an empty index usually means the fetch failed, so it is never cached
+    if SPRINT_INDEX_CACHE_TTL_SECONDS > 0 and len(sprint_index):
+        _sprint_index_cache[cache_key] = (time.monotonic(), sprint_index)
+    return sprint_index
+
+def get_current_sprint(sprint_database_id, notion_token):
+    sprint_index = _get_cached_sprint_index((notion_token, sprint_database_id))
+    if sprint_index is not None: return sprint_index.current
+
+    # ask Notion for the Current sprint only, filtering on whichever type "Sprint status" has
+    try:
+        status_type = get_database_properties(sprint_database_id, notion_token).get("Sprint status", {}).get("type")
+        if status_type in ("status", "select"):
+            query = {"filter": {"property": "Sprint status", status_type: {"equals": "Current"}}}
+            return SprintIndex(_query_notion_database(sprint_database_id, notion_token, query)).current
+    except Exception as e:
+        log(f"Warning: Filtered query for the Current sprint failed. Falling back to the full sprint list. Error: {e}")
+    return get_sprint_index(sprint_database_id, notion_token).current
+
 # ==============================================================================
-# 3. 資料處理函式 (Data Processing Functions)
+# 4. 資料處理函式 (Data Processing Functions)
 # ==============================================================================
 
-def extract_task_data(task_page, project_name_map, department_from_input, completed_statuses, notion_token):
+# one compact record per task; 'parent_task' is filled in after the pass, once every title is known
+TASK_RECORD_FIELDS = (
+    ("id", "STRING"), ("task_id_display", "STRING"), ("task_name", "STRING"), ("parent_id", "STRING"), ("parent_task", "STRING"),
+    ("assignee_identifier", "STRING"), ("assignee_count", "INTEGER"), ("story_point", "INTEGER"), ("project", "STRING"),
+    ("status", "STRING"), ("is_completed", "BOOLEAN"),
+)
+# (column, BigQuery type) of the two output tables, see "BigQuery Schema" in the README
+ALL_TASKS_FIELDS = (
+    ("id", "STRING"), ("Task_ID", "STRING"), ("task_name", "STRING"), ("Parent_task", "STRING"), ("sprint", "STRING"),
+    ("assignee_name", "STRING"), ("estimates", "INTEGER"), ("Project", "STRING"), ("Status", "STRING"),
+    ("Department", "STRING"), ("sprint_week_start_date", "DATE"),
+)
+COMPLETED_TASKS_FIELDS = (
+    ("Task_ID", "STRING"), ("Taskid", "STRING"), ("completed_sprint", "STRING"), ("assignee_name", "STRING"),
+    ("task_name", "STRING"), ("estimates", "INTEGER"), ("Department", "STRING"), ("sprint_week_start_date", "DATE"),
+)
+TASK_RECORD_COLUMNS = tuple(name for name, _ in TASK_RECORD_FIELDS)
+ALL_TASKS_COLUMNS = [name for name, _ in ALL_TASKS_FIELDS]
+COMPLETED_TASKS_COLUMNS = [name for name, _ in COMPLETED_TASKS_FIELDS]
+
+def get_arrow_schema(fields):
+    import pyarrow as pa
+    arrow_types = {"STRING": pa.string(), "INTEGER": pa.int64(), "BOOLEAN": pa.bool_(), "DATE": pa.date32()}
+    return pa.schema([(name, arrow_types[field_type]) for name, field_type in fields])
+
+class NormalizedTasks:
+    # columnar task records of one sprint plus the parent -> children index, built in a single pass
+    __slots__ = ("columns", "children_by_parent", "max_last_edited_time", "arrow_table")
+
+    def __init__(self, columns, children_by_parent, max_last_edited_time=None):
+        self.columns = columns
+        self.children_by_parent = children_by_parent
+        self.max_last_edited_time = max_last_edited_time
+        self.arrow_table = None
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def to_arrow(self):
+        # converted once and shared by both output tables
+        if self.arrow_table is None:
+            import pyarrow as pa
+            self.arrow_table = pa.Table.from_pydict(self.columns, schema=get_arrow_schema(TASK_RECORD_FIELDS))
+        return self.arrow_table
+
+    def to_frame(self):
+        # debugging only; the sync itself never needs pandas
+        return self.to_arrow().to_pandas()
+
+def extract_task_data(task_page, project_name_map, completed_statuses):
     properties = task_page.get("properties", {})
     
     task_name_prop = properties.get("Task name", {}).get("title", [])
@@ -203,21 +1164,11 @@ def extract_task_data(task_page, project_name_map, department_from_input, comple
         unique_id_data = task_id_prop.get("unique_id", {})
         prefix, number = unique_id_data.get("prefix", ""), unique_id_data.get("number")
         if number is not None: task_id_display = f"{prefix}{number}"
-    
-    parent_task = None
-    parent_relation = properties.get("Parent-task", {}).get("relation", [])
-    if parent_relation:
-        parent_id = parent_relation[0]["id"]
-        if parent_id: parent_task = get_page_title(parent_id, notion_token)
 
     assignee_prop = properties.get("Assignee", {}).get("people", [])
     assignee_identifier = assignee_prop[0].get("name", "Unassigned") if assignee_prop else "Unassigned"
     
-    estimates_prop = properties.get("Estimates", {}).get("select", {})
-    story_point = 0
-    if estimates_prop:
-        try: story_point = int(estimates_prop.get("name", 0))
-        except (ValueError, TypeError): pass
+    story_point = get_story_point(properties)
 
     project_relation = properties.get("Project", {}).get("relation", [])
     project_name = "No Project"
@@ -225,106 +1176,111 @@ def extract_task_data(task_page, project_name_map, department_from_input, comple
         project_id = project_relation[0]["id"]
         project_name = project_name_map.get(project_id, "Unknown Project")
         
-    status_prop = properties.get("Status", {})
-    status_name = "Unknown"
-    if status_prop.get("type") == "status":
-        status_name = status_prop.get("status", {}).get("name", "Unknown")
-    elif status_prop.get("type") == "select":
-        status_name = status_prop.get("select", {}).get("name", "Unknown")
+    status_name = get_select_or_status_name(properties.get("Status", {})) or "Unknown"
 
     return {"id": task_page["id"], "task_id_display": task_id_display, "task_name": task_name,
-            "parent_task": parent_task, "assignee_identifier": assignee_identifier,
-            "assignee_count": len(assignee_prop),
+            "parent_id": get_parent_task_id(task_page), "parent_task": None,
+            "assignee_identifier": assignee_identifier, "assignee_count": len(assignee_prop),
             "story_point": story_point, "project": project_name, "status": status_name,
-            "is_completed": status_name in completed_statuses, "department": department_from_input}
+            "is_completed": status_name in completed_statuses}
 
-def process_all_tasks(tasks_list_raw, sprint_name, project_name_map, has_subtask_map, department_from_input, sprint_week_start, completed_statuses, notion_token):
-    new_records = []
-    for task_page in tasks_list_raw:
-        task = extract_task_data(task_page, project_name_map, department_from_input, completed_statuses, notion_token)
-        
-        if task["assignee_count"] > 1:
-            print(f"  [DATA QUALITY RULE] Skipping task '{task['task_name']}' ({task['task_id_display']}) because it has {task['assignee_count']} assignees.")
-            continue
+def normalize_tasks(task_pages, project_name_map, completed_statuses, notion_token, page_title_cache, task_graph=None):
+    columns = {name: [] for name in TASK_RECORD_COLUMNS}
+    children_by_parent = {}
+    # full page titles, used as parent titles exactly as GET /v1/pages would return them
+    titles_by_id = {}
+    max_last_edited_time = None
+    for task_page in task_pages:
+        task = extract_task_data(task_page, project_name_map, completed_statuses)
+        # ISO 8601 timestamps in UTC compare correctly as strings
+        last_edited_time = task_page.get("last_edited_time")
+        if last_edited_time and (max_last_edited_time is None or last_edited_time > max_last_edited_time):
+            max_last_edited_time = last_edited_time
+        for name in TASK_RECORD_COLUMNS: columns[name].append(task[name])
+        if task["parent_id"]: children_by_parent.setdefault(task["parent_id"], []).append(task["id"])
+        title = get_title_from_properties(task_page.get("properties", {}))
+        titles_by_id[task["id"]] = title if title is not None else f"Unnamed Page (ID: {task['id']})"
 
-        new_records.append({
-            "id": task["id"], "Task_ID": task["task_id_display"], "task_name": task["task_name"],
-            "Parent_task": task["parent_task"], "sprint": sprint_name, "assignee_name": task["assignee_identifier"],
-            "estimates": task["story_point"], "Project": task["project"], "Status": task["status"],
-            "Department": task["department"], "sprint_week_start_date": sprint_week_start
-        })
-    if not new_records: return pd.DataFrame()
-    df = pd.DataFrame(new_records)
-    df['sprint_week_start_date'] = pd.to_datetime(df['sprint_week_start_date'], errors='coerce').dt.date
-    return df
-
-def process_complete_tasks(tasks_list_raw, sprint_name, project_name_map, department_from_input, sprint_week_start, completed_statuses, notion_token, bq_client, complete_tasks_table_id):
-    print(f"Pre-fetching completed Task_IDs from OTHER sprints (excluding '{sprint_name}')...")
-    existing_task_ids_from_other_sprints = set()
-    full_table_id = f"{BQ_PROJECT_ID}.{BQ_DATASET_ID}.{complete_tasks_table_id}"
-    try:
-        query = f"SELECT DISTINCT Task_ID FROM `{full_table_id}` WHERE completed_sprint != '{sprint_name}'"
-        query_job = bq_client.query(query)
-        for row in query_job.result(): existing_task_ids_from_other_sprints.add(row.Task_ID)
-        print(f"Found {len(existing_task_ids_from_other_sprints)} completed Task_IDs from other sprints.")
-    except Exception as e:
-        print(f"Warning: Could not fetch existing Task_IDs. Uniqueness check may not be complete. Error: {e}")
-
-    tasks_data_cache = {}
-    parent_to_children_map = {}
-    for task_page in tasks_list_raw:
-        task_info = extract_task_data(task_page, project_name_map, department_from_input, completed_statuses, notion_token)
-        tasks_data_cache[task_page["id"]] = task_info
-        parent_relation = task_page.get("properties", {}).get("Parent-task", {}).get("relation", [])
-        if parent_relation:
-            parent_id = parent_relation[0]["id"]
-            parent_to_children_map.setdefault(parent_id, []).append(task_page["id"])
-    
-    new_records = []
-    for task_id, task in tasks_data_cache.items():
-        is_eligible = (
-            task["is_completed"] and 
-            task["story_point"] != 0 and 
-            task["assignee_identifier"] != "Unassigned" and
-            task["assignee_count"] <= 1
-        )
-        if not is_eligible: 
-            if task["assignee_count"] > 1:
-                 print(f"  [DATA QUALITY RULE] Skipping completed task '{task['task_name']}' ({task['task_id_display']}) because it has {task['assignee_count']} assignees.")
-            continue
-        
-        is_parent = task_id in parent_to_children_map
-        should_add = False
-        if not is_parent:
-            should_add = True
+    with timed_stage("parent_titles"):
+        parent_title_map = resolve_parent_titles(children_by_parent.keys(), titles_by_id, notion_token, page_title_cache, task_graph)
+    columns["parent_task"] = [parent_title_map.get(parent_id) if parent_id else None for parent_id in columns["parent_id"]]
+    return NormalizedTasks(columns, children_by_parent, max_last_edited_time)
+
+def _get_sprint_week_start_date(sprint_week_start):
+    return datetime.fromisoformat(sprint_week_start).date()
+
+def build_output_table(fields, records, record_columns, constant_columns):
+    # output table taking some columns from the selected task records and filling the rest with one value
+    import pyarrow as pa
+    schema = get_arrow_schema(fields)
+    arrays = [records.column(record_columns[field.name]).cast(field.type) if field.name in record_columns
+              else pa.array([constant_columns[field.name]] * records.num_rows, type=field.type)
+              for field in schema]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def process_all_tasks(tasks, sprint_name, department_from_input, sprint_week_start):
+    columns = tasks.columns
+    kept_rows = []
+    for i, assignee_count in enumerate(columns["assignee_count"]):
+        if assignee_count > 1:
+            log(f"  [DATA QUALITY RULE] Skipping task '{columns['task_name'][i]}' ({columns['task_id_display'][i]}) because it has {assignee_count} assignees.")
         else:
-            children_ids = parent_to_children_map[task_id]
-            sum_of_children_points = sum(tasks_data_cache.get(child_id, {}).get("story_point", 0) for child_id in children_ids)
-            if sum_of_children_points == 0: should_add = True
-        
-        if should_add:
-            if task["task_id_display"] in existing_task_ids_from_other_sprints:
-                print(f"Skipping task {task['task_id_display']} as it was completed in another sprint.")
-                continue
-            
-            new_records.append({
-                "Task_ID": task["task_id_display"], "Taskid": task["id"], "completed_sprint": sprint_name,
-                "assignee_name": task["assignee_identifier"], "task_name": task["task_name"], "estimates": task["story_point"],
-                "Department": task["department"], "sprint_week_start_date": sprint_week_start
-            })
-    
-    if not new_records:
-        return pd.DataFrame(columns=["Task_ID", "Taskid", "completed_sprint", "assignee_name", "task_name", "estimates", "Department", "sprint_week_start_date"])
+            kept_rows.append(i)
+
+    return build_output_table(ALL_TASKS_FIELDS, tasks.to_arrow().take(kept_rows), {
+        "id": "id", "Task_ID": "task_id_display", "task_name": "task_name", "Parent_task": "parent_task",
+        "assignee_name": "assignee_identifier", "estimates": "story_point", "Project": "project", "Status": "status",
+    }, {"sprint": sprint_name, "Department": department_from_input, "sprint_week_start_date": _get_sprint_week_start_date(sprint_week_start)})
+
+def process_complete_tasks(tasks, sprint_name, department_from_input, sprint_week_start, completed_task_index, task_graph=None):
+    columns = tasks.columns
+
+    # a parent is only counted when its subtasks carry no points, to avoid double counting
+    children_points = {}
+    for parent_id, story_point in zip(columns["parent_id"], columns["story_point"]):
+        if parent_id: children_points[parent_id] = children_points.get(parent_id, 0) + story_point
+    parent_ids = set(tasks.children_by_parent)
+    if task_graph is not None:
+        # subtasks in other sprints count as well; this sprint's own tasks keep their freshly fetched points
+        sprint_task_ids = set(columns["id"])
+        for task_id in columns["id"]:
+            other_children = [child_id for child_id in task_graph.get_children(task_id) if child_id not in sprint_task_ids]
+            if not other_children: continue
+            parent_ids.add(task_id)
+            children_points[task_id] = children_points.get(task_id, 0) + sum(task_graph.get_story_point(child_id) for child_id in other_children)
+
+    selected_rows = []
+    for i, task_id in enumerate(columns["id"]):
+        if columns["assignee_count"][i] > 1:
+            log(f"  [DATA QUALITY RULE] Skipping completed task '{columns['task_name'][i]}' ({columns['task_id_display'][i]}) because it has {columns['assignee_count'][i]} assignees.")
+            continue
+        is_eligible = columns["is_completed"][i] and columns["story_point"][i] != 0 and columns["assignee_identifier"][i] != "Unassigned"
+        is_parent = task_id in parent_ids
+        if not is_eligible or (is_parent and children_points.get(task_id, 0) != 0): continue
+        if completed_task_index.is_completed_in_other_sprint(columns["task_id_display"][i], sprint_name):
+            log(f"Skipping task {columns['task_id_display'][i]} as it was completed in another sprint.")
+            continue
+        selected_rows.append(i)
 
-    df = pd.DataFrame(new_records)
-    df['sprint_week_start_date'] = pd.to_datetime(df['sprint_week_start_date'], errors='coerce').dt.date
-    return df
+    return build_output_table(COMPLETED_TASKS_FIELDS, tasks.to_arrow().take(selected_rows), {
+        "Task_ID": "task_id_display", "Taskid": "id", "assignee_name": "assignee_identifier", "task_name": "task_name", "estimates": "story_point",
+    }, {"completed_sprint": sprint_name, "Department": department_from_input, "sprint_week_start_date": _get_sprint_week_start_date(sprint_week_start)})
+
+def compute_sprint_fingerprint(all_tasks_table, completed_tasks_table):
+    # stable hash of exactly what would be written, including the target tables
+    digest = hashlib.sha256()
+    for table_id, table, sort_column in ((BQ_ALL_TASKS_TABLE_ID, all_tasks_table, "id"), (BQ_COMPLETED_TASKS_TABLE_ID, completed_tasks_table, "Taskid")):
+        records = table.sort_by(sort_column).to_pylist()
+        digest.update(json.dumps([table_id, records], sort_keys=True, default=str, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
 
 # ==============================================================================
-# 4. 流程協調函式 (Orchestration Function)
+# 5. 流程協調函式 (Orchestration Function)
 # ==============================================================================
 
-def process_and_upload_sprint(sprint_info, bq_client, config):
+def fetch_sprint_tasks(sprint_info, config):
+    # the Notion side of a sprint, safe to run for several sprints in parallel;
+    # returns {"tasks", "sprint_week_start", "previous_sync"}, or {"result"} when the sprint ends here
     sprint_id, sprint_name, notion_token = sprint_info["id"], sprint_info["name"], config["notion_token"]
 
     original_start_date_str = sprint_info.get("start_date")
@@ -350,61 +1306,431 @@ def process_and_upload_sprint(sprint_info, bq_client, config):
     first_monday_in_range = start_date_obj + timedelta(days=first_monday_offset)
 
     if first_monday_in_range > end_date_obj:
-        print(f"Warning: No Monday between {start_date_obj} and {end_date_obj}. Using start date as sprint_week_start.")
+        log(f"Warning: No Monday between {start_date_obj} and {end_date_obj}. Using start date as sprint_week_start.")
         sprint_week_start = start_date_obj.isoformat()
     else:
         sprint_week_start = first_monday_in_range.isoformat()
 
-    print(f"\n--- Processing Sprint: {sprint_name} (ID: {sprint_id}) ---")
-    print(f"Original start: {original_start_date_str}, Original end: {original_end_date_str}, Computed sprint_week_start: {sprint_week_start}")
+    log(f"\n--- Processing Sprint: {sprint_name} (ID: {sprint_id}) ---")
+    log(f"Original start: {original_start_date_str}, Original end: {original_end_date_str}, Computed sprint_week_start: {sprint_week_start}")
 
     try:
-        project_name_map = get_all_projects_map(notion_token=notion_token)
-        tasks_list_raw = get_tasks_for_sprint(sprint_id, notion_token=notion_token)
-        print(f"Found {len(tasks_list_raw)} tasks for this sprint.")
-        if not tasks_list_raw:
-            print("No tasks to process. Skipping.")
-            return
-
-        has_subtask_map = get_subtask_map(tasks_list_raw)
-        
-        all_tasks_df = process_all_tasks(tasks_list_raw, sprint_name, project_name_map, has_subtask_map, config["department"], sprint_week_start, config["completed_statuses"], notion_token)
-        complete_tasks_df = process_complete_tasks(tasks_list_raw, sprint_name, project_name_map, config["department"], sprint_week_start, config["completed_statuses"], notion_token, bq_client, BQ_COMPLETED_TASKS_TABLE_ID)
+        # fingerprint of this sprint's last successful write, if any
+        previous_sync = config["sprint_fingerprints"].get(sprint_id) if config["skip_unchanged"] != "none" else None
+        if previous_sync and config["skip_unchanged"] == "probe" and not sprint_info.get("is_current"):
+            # closed sprints: when no task was edited since the last sync, skip even the task fetch
+            with timed_stage("edit_time_probe"):
+                latest_edit = get_latest_task_edit_time(config["task_db_id"], sprint_id, notion_token, filter_properties=config["task_filter_properties"][:1] if config["task_filter_properties"] else None)
+            if latest_edit and latest_edit == previous_sync.get("max_last_edited_time"):
+                log(f"No task edited since {latest_edit}. Skipping fetch and upload.")
+                return {"result": {"sprint": sprint_name, "status": "unchanged", "reason": "last_edited_time"}}
+
+        project_name_map = config["project_name_map"]
+        task_pages = get_tasks_for_sprint(config["task_db_id"], sprint_id, notion_token=notion_token, filter_properties=config["task_filter_properties"])
+
+        # parse every page once as it streams in; only the compact records are kept
+        with timed_stage("fetch_and_normalize"):
+            tasks = normalize_tasks(task_pages, project_name_map, config["completed_statuses"], notion_token, config["page_title_cache"], config.get("task_graph"))
+        count_metric("tasks_fetched", len(tasks))
+        log(f"Found {len(tasks)} tasks for this sprint.")
+        if not len(tasks):
+            log("No tasks to process. Skipping.")
+            return {"result": {"sprint": sprint_name, "status": "skipped", "reason": "no tasks"}}
+        return {"tasks": tasks, "sprint_week_start": sprint_week_start, "previous_sync": previous_sync}
+
+    except Exception as e:
+        log(f"!!! An error occurred while processing sprint '{sprint_name}': {e}")
+        return {"result": {"sprint": sprint_name, "status": "failed", "error": str(e)}}
+
+def write_sprint_tables(sprint_info, fetched, bq_client, config):
+    # builds and writes the output tables of a sprint fetched by fetch_sprint_tasks. Runs for one sprint at a time
+    # in sprint order, since the completed-task dedupe depends on the sprints written before it.
+    # The fingerprint to save is returned in the result's "sync_state" and saved by process_sprints together with
+    # the checkpoint; with write_mode=batch the sprint is handed to the batch, which saves both later
+    sprint_id, sprint_name = sprint_info["id"], sprint_info["name"]
+    tasks, sprint_week_start, previous_sync = fetched["tasks"], fetched["sprint_week_start"], fetched["previous_sync"]
+    try:
+        with timed_stage("build_tables"):
+            all_tasks_table = process_all_tasks(tasks, sprint_name, config["department"], sprint_week_start)
+            completed_tasks_table = process_complete_tasks(tasks, sprint_name, config["department"], sprint_week_start, config["completed_task_index"], config.get("task_graph"))
+
+        with timed_stage("fingerprint"):
+            fingerprint = compute_sprint_fingerprint(all_tasks_table, completed_tasks_table)
+        fingerprint_record = {"sprint_name": sprint_name, "fingerprint": fingerprint, "max_last_edited_time": tasks.max_last_edited_time}
+        fingerprint_key = f"{config['fingerprint_key_prefix']}{sprint_id}"
+        if previous_sync and previous_sync.get("fingerprint") == fingerprint:
+            log(f"Sprint content unchanged (fingerprint {fingerprint[:12]}). Skipping BigQuery uploads.")
+            sync_state = {fingerprint_key: fingerprint_record} if previous_sync != fingerprint_record else {}
+            return {"sprint": sprint_name, "status": "unchanged", "reason": "fingerprint", "sync_state": sync_state}
 
-        upload_dataframe_to_bigquery(all_tasks_df, BQ_ALL_TASKS_TABLE_ID, bq_client, sprint_name=sprint_name, department=config["department"])
-        upload_dataframe_to_bigquery(complete_tasks_df, BQ_COMPLETED_TASKS_TABLE_ID, bq_client, sprint_name=sprint_name, department=config["department"])
+        write_batch = config.get("write_batch")
+        if write_batch is not None:
+            # later sprints in this run dedupe against the buffered rows, which are written before the run ends
+            config["completed_task_index"].replace_sprint(sprint_name, set(completed_tasks_table.column("Task_ID").to_pylist()))
+            result = {"sprint": sprint_name, "status": "success", "all_tasks_rows": all_tasks_table.num_rows, "completed_tasks_rows": completed_tasks_table.num_rows, "write_pending": True}
+            write_batch.add(sprint_info, {BQ_ALL_TASKS_TABLE_ID: all_tasks_table, BQ_COMPLETED_TASKS_TABLE_ID: completed_tasks_table}, result, {fingerprint_key: fingerprint_record})
+            return result
+
+        sink = config.get("sink")
+        if sink is not None:
+            with timed_stage("sink_write"):
+                all_tasks_rows = sink.write_sprint_table(all_tasks_table, "all_tasks", sprint_name, config["department"])
+                completed_tasks_rows = sink.write_sprint_table(completed_tasks_table, "completed_tasks", sprint_name, config["department"])
+        else:
+            with timed_stage("bq_upload"):
+                all_tasks_rows = upload_table_to_bigquery(all_tasks_table, BQ_ALL_TASKS_TABLE_ID, bq_client, sprint_name=sprint_name, department=config["department"], write_mode=config["write_mode"])
+                completed_tasks_rows = upload_table_to_bigquery(completed_tasks_table, BQ_COMPLETED_TASKS_TABLE_ID, bq_client, sprint_name=sprint_name, department=config["department"], write_mode=config["write_mode"])
+        if completed_tasks_table.num_rows:
+            # later sprints in this run dedupe against the rows just written, without another query
+            config["completed_task_index"].replace_sprint(sprint_name, set(completed_tasks_table.column("Task_ID").to_pylist()))
+        return {"sprint": sprint_name, "status": "success", "all_tasks_rows": all_tasks_rows, "completed_tasks_rows": completed_tasks_rows,
+                "sync_state": {fingerprint_key: fingerprint_record}}
     
     except Exception as e:
-        print(f"!!! An error occurred while processing sprint '{sprint_name}': {e}")
+        log(f"!!! An error occurred while processing sprint '{sprint_name}': {e}")
+        return {"sprint": sprint_name, "status": "failed", "error": str(e)}
+
+def is_task_graph_enabled(state_store):
+    if TASK_GRAPH_ENABLED == "auto": return state_store.durable
+    return TASK_GRAPH_ENABLED in ("1", "true", "yes")
+
+def resolve_skip_unchanged(config):
+    # fingerprints in a store other instances cannot see (the /tmp file) would let this instance skip a sprint
+    # that another instance has rewritten since, so skipping is off by default there
+    durable = config["state_store"].durable
+    if config["skip_unchanged"] is None:
+        config["skip_unchanged"] = config["default_skip_unchanged"] if durable else "none"
+    elif config["skip_unchanged"] != "none" and not durable:
+        log(f"Warning: skip_unchanged={config['skip_unchanged']} with sync state in {SYNC_STATE_PATH}, which other instances cannot see. "
+            "A sprint rewritten by another instance may be skipped; set BQ_SYNC_STATE_TABLE_ID.")
+
+def get_shared_state_store(bq_client, config):
+    # run_sync presets the state store of a sink or a snapshot run
+    if "state_store" in config: return config["state_store"]
+    return config["shared_cache"].get_or_compute(("sync_state_store",), lambda: get_sync_state_store(bq_client))
+
+def load_shared_lookups(bq_client, config):
+    # loaded lazily, so runs that end up with nothing to process skip these queries entirely
+    shared_cache = config["shared_cache"]
+    if "project_name_map" not in config:
+        # one project map per token and database for every sprint and env in this invocation
+        config["project_name_map"] = shared_cache.get_or_compute(
+            ("project_name_map", config["notion_token"], config["project_db_id"]),
+            lambda: get_all_projects_map(config["project_db_id"], notion_token=config["notion_token"]))
+        log(f"Loaded {len(config['project_name_map'])} projects.")
+    if "task_filter_properties" not in config:
+        config["task_filter_properties"] = shared_cache.get_or_compute(
+            ("task_filter_properties", config["notion_token"], config["task_db_id"]),
+            lambda: get_filter_property_ids(config["task_db_id"], config["notion_token"], property_names=TASK_PROPERTY_NAMES))
+    if "state_store" not in config:
+        config["state_store"] = get_shared_state_store(bq_client, config)
+    if "sprint_fingerprints" not in config:
+        resolve_skip_unchanged(config)
+        # every stored sprint fingerprint of this env and department, read in one query
+        config["fingerprint_key_prefix"] = f"fingerprint:{config['env']}:{config['department']}:"
+        stored = config["state_store"].get_many(config["fingerprint_key_prefix"]) if config["skip_unchanged"] != "none" else {}
+        config["sprint_fingerprints"] = {key[len(config["fingerprint_key_prefix"]):]: value for key, value in stored.items()}
+    if "task_graph" not in config:
+        # one graph per task database, shared by every env reading it
+        config["task_graph"] = shared_cache.get_or_compute(
+            ("task_graph", config["notion_token"], config["task_db_id"]),
+            lambda: load_task_graph(config["task_db_id"], config["notion_token"], config["state_store"])) if is_task_graph_enabled(config["state_store"]) else None
+    if "completed_task_index" not in config:
+        # one completed Task_ID lookup per department, also shared by envs writing the same department
+        config["completed_task_index"] = shared_cache.get_or_compute(
+            ("completed_task_index", config["department"]),
+            lambda: config["sink"].load_completed_task_index(config["department"]) if config.get("sink") else load_completed_task_index(bq_client, config["department"]))
+
+def process_sprints(sprints_to_process, bq_client, config, concurrency=1, deadline=None, checkpoint=None):
+    total_sprints = len(sprints_to_process)
+    with timed_stage("shared_lookups"): load_shared_lookups(bq_client, config)
+    # a local sink writes one file per sprint, so there is nothing to batch
+    config["write_batch"] = (SprintWriteBatch(bq_client, config["department"], config["state_store"], checkpoint)
+                             if config["write_mode"] == "batch" and config.get("sink") is None else None)
+    sprint_durations = []
+
+    def start_sprint(sprint_info):
+        # runs inside the sprint's own context, so its log prefix and metrics never leak into other sprints
+        _log_prefix.set(f"{_log_prefix.get()}[{sprint_info['name']}] ")
+        return begin_metrics_scope()
+
+    def fetch_sprint(index, sprint_info):
+        if deadline is not None:
+            # only start a sprint that is expected to finish before the deadline
+            expected_seconds = max([BACKFILL_SAFETY_MARGIN_SECONDS] + sprint_durations)
+            if time.monotonic() + expected_seconds > deadline:
+                log("Time budget nearly used up. Deferring this sprint to the next call.")
+                return {"result": {"sprint": sprint_info["name"], "status": "deferred"}}, None
+        log(f"\n>>> Processing sprint {index+1} of {total_sprints}...")
+        started_at = time.monotonic()
+        try:
+            return fetch_sprint_tasks(sprint_info, config), started_at
+        except Exception as e:
+            # invalid sprint dates are raised before any work starts
+            log(f"!!! Sprint '{sprint_info['name']}' could not be processed: {e}")
+            return {"result": {"sprint": sprint_info["name"], "status": "failed", "error": str(e)}}, started_at
+
+    def finish_sprint(sprint_info, sprint_metrics, fetched, started_at):
+        result = fetched.get("result")
+        if result is None:
+            result = write_sprint_tables(sprint_info, fetched, bq_client, config)
+        if started_at is not None: sprint_durations.append(time.monotonic() - started_at)
+        # a buffered sprint is checkpointed by its batch once the rows are written
+        write_pending = result.pop("write_pending", False)
+        sync_state = result.pop("sync_state", {})
+        if config["write_batch"] is not None and not write_pending and result["status"] not in ("failed", "deferred"):
+            # nothing to write (e.g. skipped as unchanged), but its state still goes out with the batch
+            config["write_batch"].add(sprint_info, {}, result, sync_state)
+            write_pending = True
+        if (checkpoint or sync_state) and result["status"] not in ("failed", "deferred") and not write_pending:
+            try:
+                # the fingerprint and the checkpoint in one state write
+                if checkpoint: checkpoint.mark_done([sprint_info["id"]], sync_state)
+                else: config["state_store"].put_many(sync_state)
+            except Exception as e:
+                # the rows are written, but without the checkpoint a resumed run has to redo this sprint
+                log(f"!!! Sprint '{sprint_info['name']}' was written but its sync state could not be saved: {e}")
+                result.update(status="failed", error=str(e))
+        summary = sprint_metrics.to_dict()
+        log_event("sprint_metrics", env=config["env"], department=config["department"], sprint=sprint_info["name"], status=result["status"], **summary)
+        if config.get("include_metrics"): result["metrics"] = summary
+        return result
+
+    # Notion fetches run on up to `concurrency` workers, sharing the per-token rate limiter; tables are built
+    # and written here one sprint at a time in sprint order, so "completed once" picks the same sprint on every run.
+    # At most `concurrency` fetched sprints wait ahead of the writer, which bounds memory.
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = collections.deque()
+        upcoming = iter(enumerate(sprints_to_process))
+
+        def submit_next():
+            for index, sprint_info in upcoming:
+                sprint_context = contextvars.copy_context()
+                sprint_metrics = sprint_context.run(start_sprint, sprint_info)
+                in_flight.append((sprint_info, sprint_context, sprint_metrics, executor.submit(sprint_context.run, fetch_sprint, index, sprint_info)))
+                return
+
+        for _ in range(concurrency): submit_next()
+        while in_flight:
+            sprint_info, sprint_context, sprint_metrics, future = in_flight.popleft()
+            fetched, started_at = future.result()
+            submit_next()
+            results.append(sprint_context.run(finish_sprint, sprint_info, sprint_metrics, fetched, started_at))
+    if config["write_batch"] is not None:
+        # the last partial batch; failures are recorded in the affected sprint results
+        config["write_batch"].flush()
+    return results
+
+def run_incremental_sync(current_sprint, bq_client, config, state_store):
+    # high-water mark per env, department and task database
+    state_key = f"incremental:{config['env']}:{config['department']}:{config['task_db_id']}"
+    state = state_store.get(state_key) or {}
+    # Notion rounds last_edited_time down to the minute, so the next probe overlaps by one minute
+    sync_started_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+
+    full_sync_reason = None
+    if state.get("sprint_id") != current_sprint["id"]:
+        full_sync_reason = "no previous sync of this sprint"
+    else:
+        last_synced_at = datetime.fromisoformat(state["high_water_mark"])
+        if sync_started_at - last_synced_at > timedelta(minutes=INCREMENTAL_FULL_SYNC_INTERVAL_MINUTES):
+            full_sync_reason = f"last sync is older than {INCREMENTAL_FULL_SYNC_INTERVAL_MINUTES} minutes"
+
+    if full_sync_reason is None:
+        with timed_stage("incremental_probe"):
+            has_edits = has_sprint_task_edits_since(config["task_db_id"], current_sprint["id"], state["high_water_mark"], config["notion_token"])
+        if not has_edits:
+            log(f"No task of sprint '{current_sprint['name']}' was edited since {state['high_water_mark']}. Nothing to sync.")
+            return [{"sprint": current_sprint["name"], "status": "unchanged", "since": state["high_water_mark"]}]
+        log(f"Tasks of sprint '{current_sprint['name']}' were edited since {state['high_water_mark']}. Re-syncing the sprint.")
+    else:
+        log(f"Syncing sprint '{current_sprint['name']}' in full: {full_sync_reason}.")
+
+    sprint_results = process_sprints([current_sprint], bq_client, config)
+    # the mark only moves forward once the sprint was written successfully
+    if sprint_results[0]["status"] != "failed":
+        state_store.put(state_key, {"sprint_id": current_sprint["id"], "high_water_mark": sync_started_at.isoformat(timespec="seconds")})
+    return sprint_results
+
+def run_backfill(sprints_to_process, bq_client, config, concurrency):
+    backfill = config["backfill"]
+    checkpoint = BackfillCheckpoint(get_shared_state_store(bq_client, config), backfill["run_id"], config["env"], config["department"],
+                                    get_resumed_sprint_ids(sprints_to_process, backfill))
+    pending_sprints = [sprint_info for sprint_info in sprints_to_process if not checkpoint.is_done(sprint_info["id"])]
+    if len(pending_sprints) < len(sprints_to_process):
+        log(f"Resuming backfill run {backfill['run_id']}: {len(sprints_to_process) - len(pending_sprints)} sprint(s) already done, {len(pending_sprints)} left.")
+
+    log(f"Processing {len(pending_sprints)} sprint(s) with concurrency {concurrency}.")
+    sprint_results = process_sprints(pending_sprints, bq_client, config, concurrency, deadline=config.get("deadline"), checkpoint=checkpoint)
+
+    # deferred and failed sprints are picked up again by a call with the continuation token, which also carries the
+    # done sprints, since the call may land on an instance that cannot see this one's state store
+    continuation_token = None
+    if any(result["status"] in ("deferred", "failed") for result in sprint_results):
+        token_data = {key: backfill.get(key) for key in ("run_id", "from_sprint", "to_sprint")}
+        token_data.update(get_resume_point(sprints_to_process, checkpoint), env=config["env"], department=config["department"])
+        continuation_token = encode_continuation_token(token_data)
+    return sprint_results, continuation_token
+
+def get_sprints_to_process(config, mode):
+    sprints_to_process = []
+    
+    # mode is determined earlier by parse request URL
+    if mode in ('current', 'incremental'):
+        log(f"Running in '{mode.capitalize()}' mode...")
+        # check function 
+        current_sprint = get_current_sprint(config["sprint_db_id"], notion_token=config["notion_token"])
+        if current_sprint: sprints_to_process.append(current_sprint)
+    
+    elif mode == 'backfill':
+        log("Running in 'Backfill' mode...")
+        sprint_index = get_sprint_index(config["sprint_db_id"], notion_token=config["notion_token"])
+        if sprint_index.current:
+            log(f"Found 'Current' sprint. Will process {sprint_index.current_position + 1} sprints up to this point.")
+        else:
+            log("Warning: No 'Current' sprint found to set an endpoint. All sprints will be processed.")
+
+        # optional from_sprint / to_sprint range, by the number in the sprint name
+        from_sprint, to_sprint = config["backfill"].get("from_sprint"), config["backfill"].get("to_sprint")
+        sprints_to_process = sprint_index.backfill_range(from_sprint, to_sprint)
+        if from_sprint is not None or to_sprint is not None:
+            log(f"Sprint range {from_sprint}..{to_sprint} selected {len(sprints_to_process)} sprint(s).")
+
+    return sprints_to_process
+
+def run_env_sync(config, mode, bq_client, concurrency):
+    with timed_stage("sprint_list"): sprints_to_process = get_sprints_to_process(config, mode)
+    env_result = {"env": config["env"], "department": config["department"], "mode": mode}
+    if not sprints_to_process:
+        message = "No sprints to process for the selected mode."
+        log(message)
+        return dict(env_result, status="success", message=message, sprints=[])
+
+    total_sprints = len(sprints_to_process)
+    continuation_token = None
+    if mode == 'incremental':
+        sprint_results = run_incremental_sync(sprints_to_process[0], bq_client, config, get_shared_state_store(bq_client, config))
+    elif mode == 'backfill':
+        sprint_results, continuation_token = run_backfill(sprints_to_process, bq_client, config, concurrency)
+    else:
+        log(f"Processing {total_sprints} sprint(s) with concurrency {concurrency}.")
+        sprint_results = process_sprints(sprints_to_process, bq_client, config, concurrency)
+
+    failed_sprints = [result["sprint"] for result in sprint_results if result["status"] == "failed"]
+    deferred_sprints = [result["sprint"] for result in sprint_results if result["status"] == "deferred"]
+    if failed_sprints:
+        status = "failed"
+        message = f"Data synchronization finished with {len(failed_sprints)} failed sprint(s) out of {total_sprints} in '{mode}' mode: {', '.join(failed_sprints)}."
+    elif deferred_sprints:
+        status = "incomplete"
+        message = f"Time budget reached with {len(deferred_sprints)} of {total_sprints} sprint(s) left in '{mode}' mode. Call again with the continuation token to resume."
+    else:
+        status = "success"
+        message = f"Data synchronization completed successfully for {total_sprints} sprint(s) in '{mode}' mode."
+    log(message)
+    env_result = dict(env_result, status=status, message=message, sprints=sprint_results)
+    if continuation_token: env_result["continuation_token"] = continuation_token
+    return env_result
+
+def build_env_config(env_name, env_config, department, write_mode, skip_unchanged, shared_cache, backfill):
+    # returns (config, None) or (None, (error message, HTTP status))
+    # get token variable name from current environment config
+    token_var_name = env_config.get("TOKEN_VARIABLE_NAME")
+    if not token_var_name: return None, (f"Error: TOKEN_VARIABLE_NAME not defined for env '{env_name}'.", 500)
+    
+    # input the token var name and find the secret real Notion token kept on GCP 
+    notion_token = os.environ.get(token_var_name)
+    if not notion_token: return None, (f"Error: Token environment variable '{token_var_name}' is not set.", 500)
+
+    config = {
+        "env": env_name,
+        "notion_token": notion_token,
+        "department": department,
+        "write_mode": write_mode,
+        "skip_unchanged": skip_unchanged,
+        # run_id plus optional from_sprint / to_sprint and a resumed run's done sprints, see run_backfill
+        "backfill": backfill,
+        "completed_statuses": env_config.get("COMPLETED_STATUSES", []),
+        "sprint_db_id": env_config.get("SPRINT_DB_ID"),
+        "task_db_id": env_config.get("TASK_DB_ID"),
+        "project_db_id": env_config.get("PROJECT_DB_ID"),
+        "shared_cache": shared_cache,
+        # page titles fetched during this invocation, shared by every sprint and env using this token
+        "page_title_cache": shared_cache.get_or_compute(("page_title_cache", notion_token), InvocationCache),
+    }
+    if not all([config["sprint_db_id"], config["task_db_id"], config["project_db_id"]]):
+        return None, (f"Error: Missing one or more database IDs in config for env '{env_name}'.", 500)
+    return config, None
 
 # ==============================================================================
-# 5. 主觸發函式 (Main Trigger Function)
+# 6. 主觸發函式 (Main Trigger Function)
 # ==============================================================================
 
-@functions_framework.http
-def notion_bq_sync_trigger(request):
-    """
-    HTTP Cloud Function. Supports 'current' and 'backfill' modes.
-    Uses unified JSON for configs and separate env vars for tokens.
-    """
-    print("==================================================")
-    print("Cloud Function triggered. Starting data sync process.")
-    global NOTION_SPRINT_DATABASE_ID, NOTION_TASK_DATABASE_ID, NOTION_PROJECT_DATABASE_ID
+def run_sync(args, sink=None, state_store=None):
+    # shared by the HTTP trigger and the command line; args holds the request parameters,
+    # sink=None uploads to BigQuery, a ParquetSink writes local files instead.
+    # state_store=None keeps sync state in the sink's own store, or in BQ_SYNC_STATE_TABLE_ID / SYNC_STATE_PATH
+    log("==================================================")
+    log("Sync triggered. Starting data sync process.")
+    invocation_started_at = time.monotonic()
+    # root metrics scope; env and sprint scopes add into it
+    invocation_metrics = SyncMetrics()
+    _sync_metrics.set(invocation_metrics)
     
     # 1. Parse request and load configurations
     try:
         # ex. https://...run.app/?env=dti&mode=current&department=DTI
+        #     https://...run.app/?env=all&mode=current
+        #     https://...run.app/?mode=backfill&continue=<continuation_token>
+
+        # tokens returned by an unfinished backfill; each one names its env, department and run
+        continuation = {}
+        for token in args.get('continue', '').split(','):
+            if not token.strip(): continue
+            try: token_data = decode_continuation_token(token.strip())
+            except Exception as e: return f"Error: Invalid continuation token: {e}", 400
+            continuation[token_data["env"]] = token_data
         
         # parse environment information from input request URL and set to variable 
-        selected_env = request.args.get('env')
-        if not selected_env: return "Error: 'env' parameter is required.", 400
-        selected_env = selected_env.lower()
+        env_param = args.get('env') or ",".join(continuation)
+        if not env_param: return "Error: 'env' parameter is required.", 400
         
         #parse mode information from input request URL and set to variable, set default as current mode 
-        mode = request.args.get('mode', 'current').lower()
-        print(f"Environment: '{selected_env}', Mode: '{mode}'")
+        mode = args.get('mode', 'backfill' if continuation else 'current').lower()
+        if mode not in SYNC_MODES:
+            return f"Error: Invalid mode '{mode}'. Use 'current', 'backfill' or 'incremental'.", 400
+        if continuation and mode != 'backfill':
+            return "Error: 'continue' can only be used with mode=backfill.", 400
+
+        # backfill range by sprint number and time budget in seconds
+        try:
+            from_sprint = int(args['from_sprint']) if args.get('from_sprint') else None
+            to_sprint = int(args['to_sprint']) if args.get('to_sprint') else None
+            time_budget = int(args.get('time_budget', BACKFILL_TIME_BUDGET_SECONDS))
+        except ValueError: return "Error: 'from_sprint', 'to_sprint' and 'time_budget' must be integers.", 400
+        if time_budget < 1: return "Error: 'time_budget' must be at least 1 second.", 400
+
+        # unchanged sprints are skipped by fingerprint; backfill also probes last_edited_time of closed sprints.
+        # Without the parameter this only happens with a durable state store, see resolve_skip_unchanged
+        skip_unchanged = args.get('skip_unchanged', '').lower() or None
+        if skip_unchanged is not None and skip_unchanged not in SKIP_UNCHANGED_MODES:
+            return f"Error: Invalid skip_unchanged '{skip_unchanged}'. Use one of: {', '.join(SKIP_UNCHANGED_MODES)}.", 400
+        backfill_run_id = uuid.uuid4().hex[:12]
+
+        # number of sprints processed in parallel per env, mostly useful for backfill
+        try: concurrency = int(args.get('concurrency', 1))
+        except ValueError: return "Error: 'concurrency' must be an integer.", 400
+        if concurrency < 1: return "Error: 'concurrency' must be at least 1.", 400
+        concurrency = min(concurrency, MAX_SPRINT_CONCURRENCY)
 
-        config = {}
+        # how each sprint's rows are replaced in BigQuery
+        write_mode = args.get('write_mode', BQ_WRITE_MODE).lower()
+        if write_mode not in BQ_WRITE_MODES:
+            return f"Error: Invalid write_mode '{write_mode}'. Use one of: {', '.join(BQ_WRITE_MODES)}.", 400
+
+        # stage timings and API counters in the response body; they are always written to the logs
+        include_metrics = args.get('metrics', '').lower() in ('1', 'true', 'yes')
         
         # get environment variables that are setup in Cloud Run setting
         configs_json = os.environ.get("NOTION_CONFIGS_JSON")
@@ -412,33 +1738,58 @@ def notion_bq_sync_trigger(request):
         
         # load the JSON string into a Python dict 
         all_configs = json.loads(configs_json)
-        
-        # pass in the current env variable as the key of the dict and get the correspond setting value(also a dict)
-        current_env_config = all_configs.get(selected_env)
-        if not current_env_config: return f"Error: Config for env '{selected_env}' not found.", 400
 
-        # get token variable name from current environment config
-        token_var_name = current_env_config.get("TOKEN_VARIABLE_NAME")
-        if not token_var_name: return f"Error: TOKEN_VARIABLE_NAME not defined for env '{selected_env}'.", 500
-        
-        # input the token var name and find the secret real Notion token kept on GCP 
-        notion_token = os.environ.get(token_var_name)
-        if not notion_token: return f"Error: Token environment variable '{token_var_name}' is not set.", 500
-        
-        # save real token to config dict 
-        config["notion_token"] = notion_token
-        # save department to config dict 
-        config["department"] = request.args.get('department', 'N/A')
-        # save completed statuses to config dict 
-        config["completed_statuses"] = current_env_config.get("COMPLETED_STATUSES", [])
-        
-        # save Notion database ID to variables
-        NOTION_SPRINT_DATABASE_ID = current_env_config.get("SPRINT_DB_ID")
-        NOTION_TASK_DATABASE_ID = current_env_config.get("TASK_DB_ID")
-        NOTION_PROJECT_DATABASE_ID = current_env_config.get("PROJECT_DB_ID")
+        if env_param.strip().lower() == 'all':
+            selected_envs = list(all_configs.keys())
+        else:
+            selected_envs = list(dict.fromkeys(env.strip().lower() for env in env_param.split(',') if env.strip()))
+        if not selected_envs: return "Error: 'env' parameter is required.", 400
+        log(f"Environment(s): {', '.join(selected_envs)}, Mode: '{mode}'")
+
+        # sprint names repeat across boards, so every env of a multi-env run needs its own department
+        requested_department = args.get('department')
+        multi_env = len(selected_envs) > 1
+        if multi_env and requested_department:
+            return "Error: 'department' cannot be combined with multiple envs. Set DEPARTMENT per env in NOTION_CONFIGS_JSON.", 400
+
+        shared_cache = InvocationCache()
+        env_configs = []
+        # env -> result of a multi-env run's env that cannot be synced because of its own configuration
+        config_failures = {}
+        for selected_env in selected_envs:
+            # pass in the current env variable as the key of the dict and get the correspond setting value(also a dict)
+            current_env_config = all_configs.get(selected_env)
+            if not current_env_config: return f"Error: Config for env '{selected_env}' not found.", 400
+
+            token_data = continuation.get(selected_env)
+            department = requested_department or current_env_config.get("DEPARTMENT")
+            if token_data:
+                # a resumed run keeps the department and sprint range it was started with
+                department = token_data["department"]
+                backfill = {key: token_data.get(key) for key in ("run_id", "from_sprint", "to_sprint", "done_through", "done")}
+            else:
+                backfill = {"run_id": backfill_run_id, "from_sprint": from_sprint, "to_sprint": to_sprint}
+            if not department and multi_env:
+                error = (f"Error: DEPARTMENT not defined for env '{selected_env}' (required when syncing multiple envs).", 500)
+                config = None
+            else:
+                config, error = build_env_config(selected_env, current_env_config, department or 'N/A', write_mode, skip_unchanged, shared_cache, backfill)
+            if error:
+                if not multi_env: return error
+                # reported as a failed env; the other envs are still synced
+                log(f"!!! Env '{selected_env}' cannot be synced: {error[0]}")
+                config_failures[selected_env] = {"env": selected_env, "department": department, "mode": mode, "status": "failed", "message": error[0], "sprints": []}
+                continue
+            if mode == 'backfill': config["deadline"] = invocation_started_at + time_budget
+            config["default_skip_unchanged"] = 'probe' if mode == 'backfill' else 'hash'
+            config["include_metrics"] = include_metrics
+            config["sink"] = sink
+            if state_store is not None or sink is not None: config["state_store"] = state_store or sink.state_store
+            env_configs.append(config)
 
-        if not all([NOTION_SPRINT_DATABASE_ID, NOTION_TASK_DATABASE_ID, NOTION_PROJECT_DATABASE_ID]):
-            return "Error: Missing one or more database IDs in config.", 500
+        departments = [config["department"] for config in env_configs]
+        if len(set(departments)) != len(departments):
+            return "Error: Every env in a multi-env run needs a distinct DEPARTMENT.", 500
             
     except Exception as e:
         return f"Error during configuration setup: {e}", 500
@@ -446,65 +1797,131 @@ def notion_bq_sync_trigger(request):
     # 2. Initialize BigQuery client
 
     # check function
-    bq_client = initialize_bigquery_client()
-    if bq_client is None: return "BigQuery client initialization failed.", 500
+    if sink is None:
+        with timed_stage("bigquery_client_init"): bq_client = initialize_bigquery_client()
+        if bq_client is None: return "BigQuery client initialization failed.", 500
+    else:
+        # sync state falls back to the local file store without a client
+        bq_client = None
+        log(f"Writing output to {sink.root_dir} instead of BigQuery.")
 
-    # 3. Determine which sprints to process based on mode
-    sprints_to_process = []
-    
-    # mode is determined earlier by parse request URL
-    if mode == 'current':
-        print("Running in 'Current' mode...")
-        # check function 
-        current_sprint = get_current_sprint(notion_token=config["notion_token"])
-        if current_sprint: sprints_to_process.append(current_sprint)
-    
-    elif mode == 'backfill':
-        print("Running in 'Backfill' mode...")
-        all_sprints_raw = get_sprints(notion_token=config["notion_token"])
-        sprints_list_sorted = sorted(all_sprints_raw, key=lambda s: get_sprint_number_from_name(s.get("properties", {})))
-        
-        current_sprint_index = -1
-        for i, sprint_page in enumerate(sprints_list_sorted):
-            props = sprint_page.get("properties", {})
-            status_prop = props.get("Sprint status", {})
-            status_name = status_prop.get("status", {}).get("name") if status_prop.get("type") == "status" else status_prop.get("select", {}).get("name")
-            if status_name == "Current":
-                current_sprint_index = i
-                break
-        
-        sprints_to_process_raw = []
-        if current_sprint_index != -1:
-            sprints_to_process_raw = sprints_list_sorted[:current_sprint_index + 1]
-            print(f"Found 'Current' sprint. Will process {len(sprints_to_process_raw)} sprints up to this point.")
-        else:
-            print("Warning: No 'Current' sprint found to set an endpoint. All sprints will be processed.")
-            sprints_to_process_raw = sprints_list_sorted
-
-        for sprint_page in sprints_to_process_raw:
-            props = sprint_page.get("properties", {})
-            sprints_to_process.append({
-                "id": sprint_page["id"],
-                "name": get_sprint_name_from_properties(props),
-                "start_date": props.get("Dates", {}).get("date", {}).get("start"),
-                "end_date": props.get("Dates", {}).get("date", {}).get("end")
-            })
+    # 3. Sync every env concurrently; envs sharing a token share its Notion rate limiter
+    def run_env(config):
+        _log_prefix.set(f"[{config['env']}] " if multi_env else "")
+        env_metrics = begin_metrics_scope()
+        try:
+            env_result = run_env_sync(config, mode, bq_client, concurrency)
+        except Exception as e:
+            log(f"!!! An error occurred while syncing env '{config['env']}': {e}")
+            env_result = {"env": config["env"], "department": config["department"], "mode": mode, "status": "failed", "message": f"Error: {e}", "sprints": []}
+        summary = env_metrics.to_dict()
+        log_event("env_metrics", env=config["env"], department=config["department"], mode=mode, status=env_result["status"], **summary)
+        if include_metrics: env_result["metrics"] = summary
+        return env_result
 
+    with ThreadPoolExecutor(max_workers=max(1, min(len(env_configs), MAX_ENV_CONCURRENCY))) as executor:
+        futures = {config["env"]: executor.submit(contextvars.copy_context().run, run_env, config) for config in env_configs}
+        env_results = [config_failures[env] if env in config_failures else futures[env].result() for env in selected_envs]
+
+    # 4. Build the response
+    failed_envs = [result["env"] for result in env_results if result["status"] == "failed"]
+    if multi_env:
+        incomplete_envs = [result["env"] for result in env_results if result["status"] == "incomplete"]
+        if failed_envs:
+            final_message = f"Data synchronization finished with failures in {len(failed_envs)} of {len(env_results)} env(s): {', '.join(failed_envs)}."
+        elif incomplete_envs:
+            final_message = f"Time budget reached before {len(incomplete_envs)} of {len(env_results)} env(s) finished: {', '.join(incomplete_envs)}. Call again with their continuation tokens to resume."
+        else:
+            final_message = f"Data synchronization completed successfully for {len(env_results)} env(s) in '{mode}' mode."
+        response_body = {"message": final_message, "mode": mode, "envs": env_results}
+        # one value that resumes every unfinished env at once
+        continuation_tokens = [result["continuation_token"] for result in env_results if result.get("continuation_token")]
+        if continuation_tokens: response_body["continuation_token"] = ",".join(continuation_tokens)
     else:
-        return f"Error: Invalid mode '{mode}'. Use 'current' or 'backfill'.", 400
+        final_message = env_results[0]["message"]
+        response_body = env_results[0]
+    log("\n==================================================")
+    log(final_message)
+    status_code = 500 if failed_envs else 200
+    # invocation-wide totals; with a single env this replaces the env summary and adds the client setup
+    summary = invocation_metrics.to_dict()
+    log_event("invocation_metrics", mode=mode, envs=selected_envs, status_code=status_code, **summary)
+    if include_metrics: response_body["metrics"] = summary
+    return json.dumps(response_body, ensure_ascii=False), status_code, {"Content-Type": "application/json"}
 
-    # 4. Loop through and process sprints
-    if not sprints_to_process:
-        message = "No sprints to process for the selected mode."
-        print(message)
-        return message, 200
+@functions_framework.http
+def notion_bq_sync_trigger(request):
+    """
+    HTTP Cloud Function. Supports 'current', 'backfill' and 'incremental' modes.
+    Uses unified JSON for configs and separate env vars for tokens.
+    'env' accepts a single env, a comma-separated list or 'all'; envs are synced concurrently.
+    """
+    return run_sync(request.args)
 
-    total_sprints = len(sprints_to_process)
-    for i, sprint_info in enumerate(sprints_to_process):
-        print(f"\n>>> Processing sprint {i+1} of {total_sprints}...")
-        process_and_upload_sprint(sprint_info, bq_client, config)
-
-    final_message = f"Data synchronization completed successfully for {total_sprints} sprint(s) in '{mode}' mode."
-    print("\n==================================================")
-    print(final_message)
-    return final_message, 200
+def main(argv=None):
+    # command line entry point for local runs, e.g.
+    #   python main.py --env ops --mode backfill --record ops.jsonl.gz --output-dir out/
+    #   python main.py --env ops --mode backfill --replay ops.jsonl.gz --output-dir out/
+    # NOTION_CONFIGS_JSON and the token variables are read from the environment as for the HTTP trigger
+    import argparse
+    parser = argparse.ArgumentParser(description="Sync Notion sprint data to BigQuery or to local Parquet files.")
+    parser.add_argument("--env", required=True, help="env name, comma-separated list or 'all'")
+    parser.add_argument("--mode", default="current", choices=SYNC_MODES)
+    parser.add_argument("--department")
+    parser.add_argument("--from-sprint", type=int)
+    parser.add_argument("--to-sprint", type=int)
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--skip-unchanged", choices=SKIP_UNCHANGED_MODES)
+    parser.add_argument("--write-mode", choices=BQ_WRITE_MODES)
+    parser.add_argument("--time-budget", type=int, help="seconds per call; an unfinished backfill is resumed automatically")
+    parser.add_argument("--metrics", action="store_true", help="include stage timings and API counters in the output")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--record", metavar="PATH", help="append every Notion response to this gzip JSONL snapshot")
+    source.add_argument("--replay", metavar="PATH", help="answer Notion requests from this snapshot instead of the API")
+    parser.add_argument("--output-dir", help="write Parquet files here instead of uploading to BigQuery")
+    cli_args = parser.parse_args(argv)
+
+    args = {"env": cli_args.env, "mode": cli_args.mode}
+    for name in ("department", "from_sprint", "to_sprint", "concurrency", "skip_unchanged", "write_mode", "time_budget"):
+        value = getattr(cli_args, name)
+        if value is not None: args[name] = str(value)
+    if cli_args.metrics: args["metrics"] = "true"
+
+    snapshot = None
+    if cli_args.replay:
+        # a replay never sends a request, so missing tokens only need a placeholder
+        for env_config in json.loads(os.environ.get("NOTION_CONFIGS_JSON") or "{}").values():
+            if env_config.get("TOKEN_VARIABLE_NAME"): os.environ.setdefault(env_config["TOKEN_VARIABLE_NAME"], "replay")
+        snapshot = NotionSnapshot(cli_args.replay, "replay")
+    elif cli_args.record:
+        snapshot = NotionSnapshot(cli_args.record, "record")
+    sink = ParquetSink(cli_args.output_dir) if cli_args.output_dir else None
+    if snapshot is not None:
+        # skipping depends on stored state, which would make the Notion requests differ between record and replay
+        if args.get("skip_unchanged", "none") != "none": log("Recording and replaying always process every sprint. Ignoring --skip-unchanged.")
+        args["skip_unchanged"] = "none"
+
+    # a snapshot holds the requests of a run that started from no sync state, so record and replay both use
+    # a fresh state store for this call (shared by its continuation calls) instead of the persisted one
+    state_dir_context = tempfile.TemporaryDirectory(prefix="notion-sync-state-") if snapshot is not None else contextlib.nullcontext()
+    with use_notion_snapshot(snapshot), state_dir_context as state_dir:
+        state_store = LocalFileStateStore(os.path.join(state_dir, "sync_state.json")) if state_dir else None
+        while True:
+            result = run_sync(args, sink=sink, state_store=state_store)
+            body, status_code = result[0], result[1]
+            print(body)
+            try: response_body = json.loads(body)
+            except ValueError: response_body = {}
+            continuation_token = response_body.get("continuation_token")
+            if status_code != 200 or not continuation_token: break
+            sprint_results = [result for env_result in response_body.get("envs", [response_body]) for result in env_result.get("sprints", [])]
+            if all(result["status"] == "deferred" for result in sprint_results):
+                log("No sprint fits into the time budget. Stopping; raise --time-budget to continue.")
+                break
+            # the tokens name their envs, so finished envs are not synced again
+            args = {key: value for key, value in args.items() if key not in ("env", "from_sprint", "to_sprint")}
+            args["continue"] = continuation_token
+    return 0 if status_code == 200 else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
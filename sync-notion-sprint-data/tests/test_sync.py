@@ -0,0 +1,468 @@
+# test_sync.py - 端到端同步測試 (End-to-end Sync Tests)
+#
+# Runs the real sync against the fake Notion server (in a thread) and the in-memory BigQuery stand-in from
+# benchmarks/, and checks that the rows written do not depend on how they are written (write mode, concurrency,
+# record/replay), plus the state writes around them, Notion retries, incremental mode and the skipping of unchanged sprints.
+#
+#   python -m pytest -q tests
+
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+# main.py reads its configuration at import time
+os.environ.update({
+    "BQ_PROJECT_ID": "test-project", "BQ_DATASET_ID": "test_dataset",
+    "BQ_ALL_TASKS_TABLE_ID": "all_tasks", "BQ_COMPLETED_TASKS_TABLE_ID": "completed_tasks",
+    "NOTION_REQUESTS_PER_SECOND": "1000", "FAKE_NOTION_TOKEN": "fake-token",
+})
+for name in ("BQ_SYNC_STATE_TABLE_ID", "TASK_GRAPH_ENABLED", "NOTION_API_BASE_URL"): os.environ.pop(name, None)
+
+import pyarrow.parquet as pq
+import pytest
+
+import main
+from fake_bigquery import FakeBigQueryClient
+from fake_notion import FakeNotionServer, FakeNotionWorkspace, board_config, build_board
+
+ENVS = ("ops", "wm")
+ALL_TASKS = "test-project.test_dataset.all_tasks"
+COMPLETED_TASKS = "test-project.test_dataset.completed_tasks"
+
+def _task_pages(board):
+    return board["databases"][board["config"]["TASK_DB_ID"]]
+
+def _is_eligible_leaf(page, task_pages):
+    # counted as completed on its own: Done, pointed, one assignee and no subtasks
+    properties = page["properties"]
+    has_children = any(page["id"] in [relation["id"] for relation in other["properties"]["Parent-task"]["relation"]] for other in task_pages)
+    return (properties["Status"]["status"]["name"] == "Done" and properties["Estimates"]["select"] is not None
+            and len(properties["Assignee"]["people"]) == 1 and not has_children)
+
+def _sprint_tasks(task_pages, sprint_id):
+    return [page for page in task_pages if sprint_id in [relation["id"] for relation in page["properties"]["Sprint"]["relation"]]]
+
+def build_test_boards():
+    boards = [build_board(env, sprints=4, tasks_per_sprint=40) for env in ENVS]
+    task_pages = _task_pages(boards[0])
+    # a finished task that is linked to sprints 1-3, so "completed once" has to pick one of them
+    shared_task = next(page for page in _sprint_tasks(task_pages, "ops-sprint-1") if _is_eligible_leaf(page, task_pages))
+    shared_task["properties"]["Sprint"]["relation"] = [{"id": f"ops-sprint-{number}"} for number in (1, 2, 3)]
+    # a finished parent in sprint 1 whose only subtask (with points) sits in sprint 2
+    parent = next(page for page in _sprint_tasks(task_pages, "ops-sprint-1") if page is not shared_task and _is_eligible_leaf(page, task_pages))
+    child = next(page for page in _sprint_tasks(task_pages, "ops-sprint-2")
+                 if not page["properties"]["Parent-task"]["relation"] and page["properties"]["Estimates"]["select"] is not None)
+    child["properties"]["Parent-task"]["relation"] = [{"id": parent["id"]}]
+    return boards, shared_task, parent
+
+@pytest.fixture
+def fake_notion():
+    boards, shared_task, parent = build_test_boards()
+    server = FakeNotionServer(("127.0.0.1", 0), FakeNotionWorkspace(boards))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield {"url": f"http://127.0.0.1:{server.server_address[1]}/v1", "server": server, "boards": boards, "shared_task": shared_task, "parent": parent}
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def sync(fake_notion, tmp_path, monkeypatch):
+    # run_sync against the fake services with fresh instance caches and a state file of its own
+    configs = {env: dict(board_config(env), TOKEN_VARIABLE_NAME="FAKE_NOTION_TOKEN") for env in ENVS}
+    monkeypatch.setenv("NOTION_CONFIGS_JSON", json.dumps(configs))
+    monkeypatch.setattr(main, "NOTION_API_BASE_URL", fake_notion["url"])
+    monkeypatch.setattr(main, "SYNC_STATE_PATH", str(tmp_path / "state.json"))
+    monkeypatch.setattr(main, "print", lambda *args, **kwargs: None, raising=False)
+    clear_instance_caches()
+
+    def run(args, client=None, **kwargs):
+        client = client or new_client()
+        monkeypatch.setattr(main, "_bigquery_client", client)
+        body, status_code = main.run_sync(dict(args), **kwargs)[:2]
+        return json.loads(body), status_code, client
+    return run
+
+def clear_instance_caches():
+    # what a warm instance would keep between calls
+    for cache in (main._project_map_cache, main._sprint_index_cache, main._database_properties_cache): cache.clear()
+
+def new_client():
+    return FakeBigQueryClient(project="test-project", schemas={ALL_TASKS: main.ALL_TASKS_COLUMNS, COMPLETED_TASKS: main.COMPLETED_TASKS_COLUMNS})
+
+def table_rows(client, table_id):
+    return sorted(json.dumps(row, sort_keys=True, default=str) for row in client.tables.get(table_id, []))
+
+def written_rows(client):
+    return {table_id: table_rows(client, table_id) for table_id in (ALL_TASKS, COMPLETED_TASKS)}
+
+def parquet_rows(output_dir):
+    return {name: sorted(json.dumps(row, sort_keys=True, default=str) for row in pq.read_table(os.path.join(output_dir, name)).to_pylist())
+            for name in ("all_tasks", "completed_tasks")}
+
+def rename_task(page, title, edited_at):
+    # an edit in Notion: new title and last_edited_time
+    page["properties"]["Task name"]["title"] = [{"type": "text", "plain_text": title}]
+    page["last_edited_time"] = edited_at
+
+def task_names(client, task_id):
+    return sorted(row["task_name"] for row in client.tables.get(ALL_TASKS, []) if row["id"] == task_id)
+
+def completed_sprints(client, task_id):
+    return sorted(row["completed_sprint"] for row in client.tables.get(COMPLETED_TASKS, []) if row["Taskid"] == task_id)
+
+BACKFILL = {"env": "all", "mode": "backfill", "skip_unchanged": "none"}
+
+# ==============================================================================
+# Notion 用戶端 (Notion Client)
+# ==============================================================================
+
+def test_rate_limiter_below_one_request_per_second():
+    limiter = main.TokenBucketRateLimiter(0.5)
+    started_at = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - started_at < 0.1
+    # the next token takes 1 / 0.5 seconds to refill
+    limiter.tokens = 0.9
+    limiter.acquire()
+    assert time.monotonic() - started_at < 1
+
+# ==============================================================================
+# 寫入模式與平行處理 (Write Modes and Concurrency)
+# ==============================================================================
+
+def test_write_modes_write_identical_rows(sync):
+    expected = None
+    for write_mode in main.BQ_WRITE_MODES:
+        client = new_client()
+        # the second run replaces every sprint that the first one wrote
+        for _ in range(2):
+            body, status_code, _ = sync(dict(BACKFILL, write_mode=write_mode), client)
+            assert status_code == 200, body
+        rows = written_rows(client)
+        assert rows[ALL_TASKS] and rows[COMPLETED_TASKS]
+        if expected is None: expected = rows
+        assert rows == expected, write_mode
+
+def test_partition_mode_keeps_other_departments(sync):
+    _, _, expected = sync(BACKFILL)
+    # both departments have sprints in the same weeks; one scheduler job per env writes them at the same time
+    client = FakeBigQueryClient(project="test-project", schemas={ALL_TASKS: main.ALL_TASKS_COLUMNS, COMPLETED_TASKS: main.COMPLETED_TASKS_COLUMNS},
+                                partitioned_tables={ALL_TASKS, COMPLETED_TASKS})
+    for _ in range(2):
+        results = []
+        threads = [threading.Thread(target=lambda env=env: results.append(sync(dict(BACKFILL, env=env, write_mode="partition"), client)[1]))
+                   for env in ENVS]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        assert results == [200, 200]
+    assert written_rows(client) == written_rows(expected)
+    merges = [job.statement for job in client.jobs if job.job_type == "MERGE"]
+    assert merges and all("T.sprint_week_start_date = @week_start" in statement for statement in merges)
+
+def test_concurrency_does_not_change_rows(sync, fake_notion):
+    _, _, sequential = sync(dict(BACKFILL, concurrency="1"))
+    assert completed_sprints(sequential, fake_notion["shared_task"]["id"]) == ["Sprint 1"]
+    for _ in range(3):
+        _, status_code, concurrent = sync(dict(BACKFILL, concurrency="4"))
+        assert status_code == 200
+        assert written_rows(concurrent) == written_rows(sequential)
+
+def test_batch_mode_uses_one_delete_and_load_per_table(sync):
+    _, _, client = sync(dict(BACKFILL, write_mode="batch"))
+    jobs_by_type = client.summary()["jobs_by_type"]
+    # one department lookup and one batch per env
+    assert jobs_by_type == {"SELECT": 2, "DELETE": 4, "LOAD": 4}
+
+def test_batch_mode_saves_state_once_per_batch(sync, monkeypatch):
+    monkeypatch.setattr(main, "BQ_SYNC_STATE_TABLE_ID", "sync_state")
+    client = new_client()
+    for _ in range(2):
+        body, status_code, _ = sync(dict(BACKFILL, env="ops", write_mode="batch"), client)
+        assert status_code == 200, body
+    state_merges = [job for job in client.jobs if job.job_type == "MERGE" and "sync_state" in job.statement]
+    # every fingerprint and the checkpoint of a run go out in one MERGE (the graph is saved on the first run)
+    assert len(state_merges) == 3
+    state_keys = {row["state_key"] for row in client.tables["test-project.test_dataset.sync_state"]}
+    assert sum(key.startswith("fingerprint:ops:") for key in state_keys) == len(body["sprints"])
+
+def test_each_written_sprint_saves_state_once(sync, monkeypatch):
+    monkeypatch.setattr(main, "BQ_SYNC_STATE_TABLE_ID", "sync_state")
+    body, status_code, client = sync(dict(BACKFILL, env="ops"))
+    assert status_code == 200, body
+    state_merges = [job for job in client.jobs if job.job_type == "MERGE" and "sync_state" in job.statement]
+    # fingerprint and checkpoint together, plus the task graph
+    assert len(state_merges) == len(body["sprints"]) + 1
+
+def test_misconfigured_env_does_not_stop_the_others(sync, monkeypatch):
+    configs = {env: dict(board_config(env), TOKEN_VARIABLE_NAME="FAKE_NOTION_TOKEN") for env in ENVS}
+    configs["wm"]["TOKEN_VARIABLE_NAME"] = "MISSING_NOTION_TOKEN"
+    monkeypatch.setenv("NOTION_CONFIGS_JSON", json.dumps(configs))
+    monkeypatch.delenv("MISSING_NOTION_TOKEN", raising=False)
+    body, status_code, client = sync(dict(BACKFILL, env="all"))
+    assert status_code == 500
+    results = {result["env"]: result for result in body["envs"]}
+    assert results["ops"]["status"] == "success" and results["ops"]["sprints"]
+    assert results["wm"]["status"] == "failed" and "MISSING_NOTION_TOKEN" in results["wm"]["message"]
+    assert {row["Department"] for row in client.tables[ALL_TASKS]} == {"OPS"}
+
+def record_rate_limit_pauses(monkeypatch):
+    # no jitter, so every pause is exactly the Retry-After or backoff delay
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: low)
+    pause = main.TokenBucketRateLimiter.pause
+    pauses = []
+
+    def recording_pause(self, seconds):
+        pauses.append(seconds)
+        return pause(self, seconds)
+    monkeypatch.setattr(main.TokenBucketRateLimiter, "pause", recording_pause)
+    return pauses
+
+def test_rate_limited_requests_are_retried(sync, fake_notion, monkeypatch):
+    _, _, expected = sync(dict(BACKFILL, env="ops"))
+    pauses = record_rate_limit_pauses(monkeypatch)
+    fake_notion["server"].rate_limit_every = 3
+    fake_notion["server"].retry_after = "0.05"
+    clear_instance_caches()
+    body, status_code, client = sync(dict(BACKFILL, env="ops", metrics="true"))
+    assert status_code == 200, body
+    assert written_rows(client) == written_rows(expected)
+    counters = body["metrics"]["counters"]
+    assert counters["notion_429s"] == counters["notion_retries"] == fake_notion["server"].stats["rate_limited"] > 0
+    # the Retry-After header sets the wait
+    assert pauses and set(pauses) == {0.05}
+
+def test_rate_limited_requests_back_off_without_retry_after(sync, fake_notion, monkeypatch):
+    pauses = record_rate_limit_pauses(monkeypatch)
+    monkeypatch.setattr(main, "NOTION_MAX_BACKOFF_SECONDS", 0.2)
+    fake_notion["server"].rate_limit_every = 2
+    fake_notion["server"].retry_after = None
+    body, status_code, _ = sync(dict(BACKFILL, env="ops"))
+    assert status_code == 200, body
+    # a 1 s first backoff, capped at 0.2 s, of which at least half is waited
+    assert pauses and set(pauses) == {0.1}
+
+def test_notion_request_gives_up_after_the_last_retry(sync, fake_notion, monkeypatch):
+    pauses = record_rate_limit_pauses(monkeypatch)
+    monkeypatch.setattr(main, "NOTION_MAX_RETRIES", 2)
+    fake_notion["server"].rate_limit_every = 1
+    fake_notion["server"].retry_after = None
+    with pytest.raises(main.requests.HTTPError, match="429"):
+        main.notion_request("GET", "databases/ops-task-db", "fake-token")
+    # the backoff doubles with every attempt
+    assert pauses == [0.5, 1.0]
+    assert fake_notion["server"].stats["rate_limited"] == 3
+
+# ==============================================================================
+# 增量同步 (Incremental Sync)
+# ==============================================================================
+
+INCREMENTAL = {"env": "ops", "mode": "incremental"}
+
+def test_incremental_sync_skips_an_unedited_sprint(sync, fake_notion):
+    client = new_client()
+    body, status_code, _ = sync(INCREMENTAL, client)
+    assert status_code == 200 and body["sprints"][0]["status"] == "success", body
+    jobs = len(client.jobs)
+    fake_notion["server"].stats.clear()
+
+    body, status_code, _ = sync(INCREMENTAL, client)
+    assert status_code == 200 and body["sprints"][0]["status"] == "unchanged" and body["sprints"][0]["since"], body
+    # the probe replaces the task fetch, and nothing is written
+    assert fake_notion["server"].stats.get("database_query") == 2 and len(client.jobs) == jobs
+
+def test_incremental_sync_resyncs_an_edited_sprint(sync, fake_notion):
+    task = _sprint_tasks(_task_pages(fake_notion["boards"][0]), "ops-sprint-4")[0]
+    client = new_client()
+    sync(INCREMENTAL, client)
+    rename_task(task, "RENAMED", "2030-01-01T00:00:00.000Z")
+    body, status_code, _ = sync(INCREMENTAL, client)
+    assert status_code == 200 and body["sprints"][0]["status"] == "success", body
+    assert task_names(client, task["id"]) == ["RENAMED"]
+
+def test_incremental_sync_runs_in_full_after_the_interval(sync, fake_notion, tmp_path):
+    task = _sprint_tasks(_task_pages(fake_notion["boards"][0]), "ops-sprint-4")[0]
+    client = new_client()
+    sync(INCREMENTAL, client)
+    # an edit the probe cannot see, e.g. a task moved out of the sprint, only shows up in a full sync
+    rename_task(task, "RENAMED", "2000-01-01T00:00:00.000Z")
+    state_path = tmp_path / "state.json"
+    state = json.loads(state_path.read_text(encoding="utf-8"))
+    state["incremental:ops:OPS:ops-task-db"]["high_water_mark"] = "2020-01-01T00:00:00+00:00"
+    state_path.write_text(json.dumps(state), encoding="utf-8")
+    body, status_code, _ = sync(INCREMENTAL, client)
+    assert status_code == 200 and body["sprints"][0]["status"] == "success", body
+    assert task_names(client, task["id"]) == ["RENAMED"]
+
+# ==============================================================================
+# 檢查點與續跑 (Checkpoints and Resuming)
+# ==============================================================================
+
+def test_failed_checkpoint_write_only_fails_that_sprint(sync, monkeypatch):
+    mark_done = main.BackfillCheckpoint.mark_done
+    calls = []
+
+    def flaky_mark_done(self, sprint_ids, other_state=None):
+        calls.append(sprint_ids)
+        if len(calls) == 2: raise OSError("state store unavailable")
+        return mark_done(self, sprint_ids, other_state)
+    monkeypatch.setattr(main.BackfillCheckpoint, "mark_done", flaky_mark_done)
+
+    body, status_code, _ = sync(dict(BACKFILL, env="ops"))
+    assert status_code == 500
+    statuses = [result["status"] for result in body["sprints"]]
+    assert statuses.count("failed") == 1 and statuses.count("success") == len(statuses) - 1
+    # the failed sprint is picked up again with the continuation token
+    assert body["continuation_token"]
+
+def test_continuation_resumes_on_another_instance(sync, tmp_path, monkeypatch):
+    # sprint 2 fails once; the continuation call lands on an instance with an empty /tmp state file
+    fetch_sprint_tasks = main.fetch_sprint_tasks
+    failures = []
+
+    def flaky_fetch(sprint_info, config):
+        if sprint_info["id"] == "ops-sprint-2" and not failures:
+            failures.append(sprint_info["id"])
+            return {"result": {"sprint": sprint_info["name"], "status": "failed", "error": "Notion unavailable"}}
+        return fetch_sprint_tasks(sprint_info, config)
+    monkeypatch.setattr(main, "fetch_sprint_tasks", flaky_fetch)
+
+    client = new_client()
+    body, status_code, _ = sync(dict(BACKFILL, env="ops"), client)
+    assert status_code == 500 and [result["status"] for result in body["sprints"]] == ["success", "failed", "success", "success"]
+
+    monkeypatch.setattr(main, "SYNC_STATE_PATH", str(tmp_path / "other_instance.json"))
+    clear_instance_caches()
+    body, status_code, _ = sync({"continue": body["continuation_token"], "skip_unchanged": "none"}, client)
+    assert status_code == 200, body
+    # only the failed sprint is redone
+    assert [result["sprint"] for result in body["sprints"]] == ["Sprint 2"]
+    assert "continuation_token" not in body
+    _, _, expected = sync(dict(BACKFILL, env="ops"))
+    assert written_rows(client) == written_rows(expected)
+
+# ==============================================================================
+# 工作區任務圖 (Workspace Task Graph)
+# ==============================================================================
+
+def test_task_graph_is_only_built_with_a_durable_state_store(sync, tmp_path, monkeypatch):
+    sync(dict(BACKFILL, env="ops"))
+    # the local /tmp state file does not survive a cold start, so the full scan is not worth it
+    with open(tmp_path / "state.json", encoding="utf-8") as f:
+        assert not any(key.startswith("task_graph:") for key in json.load(f))
+
+    monkeypatch.setattr(main, "BQ_SYNC_STATE_TABLE_ID", "sync_state")
+    _, _, client = sync(dict(BACKFILL, env="ops"))
+    assert any(row["state_key"].startswith("task_graph:") for row in client.tables["test-project.test_dataset.sync_state"])
+
+@pytest.mark.parametrize("task_graph_enabled", ["true", "false"])
+def test_subtask_points_in_other_sprints(sync, fake_notion, monkeypatch, task_graph_enabled):
+    monkeypatch.setattr(main, "TASK_GRAPH_ENABLED", task_graph_enabled)
+    _, status_code, client = sync(dict(BACKFILL, env="ops"))
+    assert status_code == 200
+    # the parent's points are already counted through its subtask in sprint 2; only the graph can see that
+    expected = [] if task_graph_enabled == "true" else ["Sprint 1"]
+    assert completed_sprints(client, fake_notion["parent"]["id"]) == expected
+
+# ==============================================================================
+# 快照與 Parquet 輸出 (Snapshots and Parquet Output)
+# ==============================================================================
+
+def test_replay_writes_the_recorded_rows_without_network(sync, tmp_path, monkeypatch):
+    snapshot_path = str(tmp_path / "snapshot.jsonl.gz")
+    assert main.main(["--env", "all", "--mode", "backfill", "--record", snapshot_path, "--output-dir", str(tmp_path / "recorded")]) == 0
+    # nothing is listening on the discard port, so any request that misses the snapshot fails its sprint
+    monkeypatch.setattr(main, "NOTION_API_BASE_URL", "http://127.0.0.1:9/v1")
+    clear_instance_caches()
+    assert main.main(["--env", "all", "--mode", "backfill", "--replay", snapshot_path, "--output-dir", str(tmp_path / "replayed")]) == 0
+    assert parquet_rows(tmp_path / "replayed") == parquet_rows(tmp_path / "recorded")
+
+def test_sync_state_is_kept_per_output_dir(sync, tmp_path):
+    assert main.main(["--env", "ops", "--mode", "backfill", "--output-dir", str(tmp_path / "first")]) == 0
+    clear_instance_caches()
+    # a new directory starts empty, so the sprints written to the first one must not be skipped as unchanged
+    assert main.main(["--env", "ops", "--mode", "backfill", "--output-dir", str(tmp_path / "second")]) == 0
+    assert parquet_rows(tmp_path / "second") == parquet_rows(tmp_path / "first")
+    assert not (tmp_path / "state.json").exists()
+
+def test_parquet_run_does_not_skip_a_later_bigquery_run(sync, tmp_path):
+    sync({"env": "all", "mode": "backfill"}, sink=main.ParquetSink(str(tmp_path / "out")))
+    clear_instance_caches()
+    body, status_code, client = sync({"env": "all", "mode": "backfill"})
+    assert status_code == 200, body
+    clear_instance_caches()
+    _, _, expected = sync(BACKFILL)
+    assert written_rows(client) == written_rows(expected)
+
+# ==============================================================================
+# 略過未變更的 Sprint (Skipping Unchanged Sprints)
+# ==============================================================================
+
+def test_local_state_does_not_skip_a_sprint_another_instance_rewrote(sync, fake_notion, tmp_path, monkeypatch):
+    # two Cloud Function instances, each with its own /tmp state file, writing to the same BigQuery tables
+    task = _sprint_tasks(_task_pages(fake_notion["boards"][0]), "ops-sprint-4")[0]
+    title = task["properties"]["Task name"]["title"][0]["plain_text"]
+    client = new_client()
+    current = {"env": "ops", "mode": "current"}
+    monkeypatch.setattr(main, "SYNC_STATE_PATH", str(tmp_path / "instance_a.json"))
+    sync(current, client)
+    rename_task(task, "RENAMED", "2030-01-01T00:00:00.000Z")
+    monkeypatch.setattr(main, "SYNC_STATE_PATH", str(tmp_path / "instance_b.json"))
+    sync(current, client)
+    assert task_names(client, task["id"]) == ["RENAMED"]
+
+    # back to the content instance A last wrote; its own fingerprint still matches, BigQuery does not
+    rename_task(task, title, "2030-01-02T00:00:00.000Z")
+    monkeypatch.setattr(main, "SYNC_STATE_PATH", str(tmp_path / "instance_a.json"))
+    body, status_code, _ = sync(current, client)
+    assert status_code == 200 and body["sprints"][0]["status"] == "success", body
+    assert task_names(client, task["id"]) == [title]
+
+def test_durable_state_skips_unchanged_sprints_by_default(sync, fake_notion, monkeypatch):
+    monkeypatch.setattr(main, "BQ_SYNC_STATE_TABLE_ID", "sync_state")
+    task = next(page for page in _sprint_tasks(_task_pages(fake_notion["boards"][0]), "ops-sprint-2") if page is not fake_notion["shared_task"])
+    get_tasks_for_sprint = main.get_tasks_for_sprint
+    fetched = []
+
+    def recording_get_tasks(task_database_id, sprint_id, *args, **kwargs):
+        fetched.append(sprint_id)
+        return get_tasks_for_sprint(task_database_id, sprint_id, *args, **kwargs)
+    monkeypatch.setattr(main, "get_tasks_for_sprint", recording_get_tasks)
+    client = new_client()
+    sync({"env": "ops", "mode": "backfill"}, client)
+    jobs = len(client.jobs)
+    fetched.clear()
+
+    # backfill probes the closed sprints instead of fetching them and compares the current sprint's fingerprint
+    body, status_code, _ = sync({"env": "ops", "mode": "backfill"}, client)
+    assert status_code == 200, body
+    assert [result.get("reason") for result in body["sprints"]] == ["last_edited_time"] * 3 + ["fingerprint"]
+    assert {result["status"] for result in body["sprints"]} == {"unchanged"}
+    assert fetched == ["ops-sprint-4"]
+    # only state reads and checkpoint writes, nothing touches the output tables
+    assert not [job for job in client.jobs[jobs:] if job.job_type != "SELECT" and "sync_state" not in getattr(job, "statement", "")]
+
+    # an edit in a closed sprint moves its latest last_edited_time, so only that sprint is written again
+    rename_task(task, "RENAMED", "2030-01-01T00:00:00.000Z")
+    body, status_code, _ = sync({"env": "ops", "mode": "backfill"}, client)
+    assert status_code == 200, body
+    assert [result["status"] for result in body["sprints"]] == ["unchanged", "success", "unchanged", "unchanged"]
+    assert task_names(client, task["id"]) == ["RENAMED"]
+
+    # current mode compares fingerprints by default
+    body, status_code, _ = sync({"env": "ops", "mode": "current"}, client)
+    assert status_code == 200 and body["sprints"][0]["reason"] == "fingerprint", body
+
+def test_explicit_skip_unchanged_with_local_state_warns(sync, monkeypatch):
+    messages = []
+    monkeypatch.setattr(main, "log", lambda message="": messages.append(message))
+    client = new_client()
+    sync({"env": "ops", "mode": "current"}, client)
+    assert not any("Warning: skip_unchanged" in message for message in messages)
+    # asked for explicitly, the local fingerprints are used, with a warning that other instances cannot see them
+    body, status_code, _ = sync({"env": "ops", "mode": "current", "skip_unchanged": "hash"}, client)
+    assert status_code == 200 and body["sprints"][0]["status"] == "unchanged", body
+    assert any("Warning: skip_unchanged=hash" in message for message in messages)